@@ -0,0 +1,661 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Offline benchmarks for the game server.
+#
+#   They run against the App Engine SDK service stubs (memcache, datastore,
+#   channel and task queue) set up through testbed, so nothing has to be
+#   deployed. The SDK has to be importable, e.g.
+#
+#       PYTHONPATH=$APPENGINE_SDK:$APPENGINE_SDK/lib/django_0_96 python bench.py
+#
+#   Run a single benchmark by passing its name: python bench.py fanout
+
+import os
+import sys
+import time
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+ROOT = os.path.dirname (os.path.abspath (__file__))
+
+def setup_testbed ():
+    tb = testbed.Testbed ()
+    tb.activate ()
+    tb.init_datastore_v3_stub ()
+    tb.init_memcache_stub ()
+    tb.init_channel_stub ()
+    tb.init_taskqueue_stub (root_path=ROOT)
+    tb.init_user_stub ()
+    return tb
+
+def timeit (fn, repeat=5):
+    """
+    Runs fn `repeat` times and returns the best wall time in milliseconds
+    """
+    best = None
+    for i in xrange (repeat):
+        start = time.time ()
+        fn ()
+        elapsed = (time.time () - start) * 1000.0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+class RpcCounter (object):
+    """
+    Counts the API calls made, per service, while installed
+    """
+    def __init__ (self):
+        self.calls = {}
+
+    def __call__ (self, service, call, request, response):
+        self.calls[service] = self.calls.get (service, 0) + 1
+
+    def install (self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks ().Append ('bench_rpc_counter', self)
+
+    def uninstall (self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks ().Clear ()
+
+def count_rpcs (fn):
+    counter = RpcCounter ()
+    counter.install ()
+    try:
+        fn ()
+    finally:
+        counter.uninstall ()
+    return counter.calls
+
+def bench_fanout ():
+    """
+    Latency of BaseGameServer.send_updates as seen by the request, and the
+    time the workers need to drain the batches, for growing rooms
+    """
+    import fanout
+    from tournament2 import DeathMatch
+
+    queue = fanout.LocalQueue ()
+    old_backend = fanout.set_backend (queue)
+    print '%10s %14s %14s %10s' % ('channels', 'request (ms)', 'workers (ms)', 'batches')
+    try:
+        for n in (10, 100, 1000, 10000):
+            room = DeathMatch (key_name='bench-%d' % n,
+                               channels=['channel-%d' % i for i in xrange (n)])
+            room._delta = {'delta_chat' : 'hello', 'player' : 'bench'}
+            request_ms = timeit (room.send_updates, repeat=1)
+            batches = len (queue.pending)
+            start = time.time ()
+            queue.run ()
+            worker_ms = (time.time () - start) * 1000.0
+            print '%10d %14.2f %14.2f %10d' % (n, request_ms, worker_ms, batches)
+    finally:
+        fanout.set_backend (old_backend)
+
+class SlowChannelStub (object):
+    """
+    Wraps the channel stub so that every send takes `latency` seconds, like
+    a real RPC would, and concurrent sends overlap
+    """
+    def __init__ (self, stub, latency):
+        self.stub = stub
+        self.latency = latency
+
+    def MakeSyncCall (self, service, call, request, response):
+        time.sleep (self.latency)
+        self.stub.MakeSyncCall (service, call, request, response)
+
+    def CreateRPC (self):
+        from google.appengine.api import apiproxy_rpc
+        latency = self.latency
+        class SlowRPC (apiproxy_rpc.RPC):
+            def _MakeCallImpl (self):
+                apiproxy_rpc.RPC._MakeCallImpl (self)
+                self.delay = threading.Thread (target=time.sleep, args=(latency,))
+                self.delay.start ()
+            def _WaitImpl (self):
+                self.delay.join ()
+                return apiproxy_rpc.RPC._WaitImpl (self)
+        return SlowRPC (stub=self.stub)
+
+def bench_channel_send ():
+    """
+    Broadcast latency of a room update sent one channel after the other and
+    with the sends running in parallel, for growing rooms, with 20ms sends
+    """
+    import fanout
+    from google.appengine.api import channel
+
+    service = channel._GetService ()
+    stub = apiproxy_stub_map.apiproxy.GetStub (service)
+    apiproxy_stub_map.apiproxy.ReplaceStub (service, SlowChannelStub (stub, 0.02))
+    print '%10s %16s %16s %10s' % ('channels', 'serial (ms)', 'parallel (ms)', 'speed-up')
+    try:
+        for n in (5, 20, 100):
+            channel_ids = ['bench-send-%d-%d' % (n, i) for i in xrange (n)]
+            for channel_id in channel_ids:
+                channel.create_channel (channel_id)
+            serial = timeit (lambda: fanout.send_many (channel_ids, 'hello', in_flight=1),
+                             repeat=1)
+            parallel = timeit (lambda: fanout.send_many (channel_ids, 'hello'), repeat=3)
+            print '%10d %16.2f %16.2f %9.1fx' % (n, serial, parallel, serial / parallel)
+    finally:
+        apiproxy_stub_map.apiproxy.ReplaceStub (service, stub)
+
+def bench_chatlog ():
+    """
+    Per-message cost of writing chat, with the old blob on the room entity
+    and with the segmented ChatLog, for rooms with a growing history
+    """
+    from chat import ChatLog
+    from tournament2 import DeathMatch, serialize_entities
+
+    line = 'x' * 60
+    messages = 50
+    print '%10s %16s %16s' % ('history', 'blob (ms/msg)', 'log (ms/msg)')
+    for history in (10, 1000, 100000):
+        room = DeathMatch (key_name='bench-chat-%d' % history,
+                           chat=line * history)
+        def blob ():
+            for i in xrange (messages):
+                room.chat += line
+                serialize_entities (room)
+        tail = [history]
+        def log ():
+            for i in xrange (messages):
+                tail[0] = ChatLog.append (room.keyname, tail[0], 'bench', line)
+        print '%10d %16.3f %16.3f' % (history,
+                                      timeit (blob, repeat=1) / messages,
+                                      timeit (log, repeat=1) / messages)
+
+def bench_get2 ():
+    """
+    Bulk loading 1, 20 and 500 players with get2: from the datastore with a
+    cold memcache, from memcache, and for players which do not exist
+    """
+    from google.appengine.api import memcache
+    from google.appengine.ext import db
+    from tournament2 import Player, get2
+
+    print '%6s %12s %12s %12s' % ('keys', 'cold (ms)', 'warm (ms)', 'missing (ms)')
+    for n in (1, 20, 500):
+        players = [Player (key_name='bench-player-%d' % i, name='p%d' % i)
+                   for i in xrange (n)]
+        db.put (players)
+        keys = [x.key () for x in players]
+        missing = [db.Key.from_path ('Player', 'bench-nobody-%d' % i)
+                   for i in xrange (n)]
+        memcache.flush_all ()
+        cold = timeit (lambda: get2 (keys), repeat=1)
+        warm = timeit (lambda: get2 (keys))
+        get2 (missing)
+        negative = timeit (lambda: get2 (missing))
+        print '%6d %12.2f %12.2f %12.2f' % (n, cold, warm, negative)
+
+def bench_codec ():
+    """
+    Encode and decode time and size of cached rooms, protobuf against the
+    compact codec
+    """
+    import codec
+    from tournament2 import DeathMatch
+
+    rooms = []
+    for players, channels in ((5, 10), (20, 100), (20, 1000)):
+        rooms.append (('%d players %d channels' % (players, channels),
+                       DeathMatch (key_name='bench-codec-%d' % channels,
+                                   players=['player-%d' % i for i in xrange (players)],
+                                   channels=['%032x' % i for i in xrange (channels)],
+                                   chat_tail=channels * 10)))
+    rooms.append (('legacy 10KB chat',
+                   DeathMatch (key_name='bench-codec-chat', chat='x' * 10240)))
+    loops = 200
+    print '%-24s %-9s %12s %12s %8s' % ('room', 'codec', 'encode (us)', 'decode (us)', 'bytes')
+    for name, room in rooms:
+        for codec_name, c in (('protobuf', codec.protobuf_codec),
+                              ('compact', codec.compact_codec)):
+            data = c.encode (room)
+            encode = timeit (lambda: [c.encode (room) for i in xrange (loops)])
+            decode = timeit (lambda: [codec.decode (data) for i in xrange (loops)])
+            print '%-24s %-9s %12.1f %12.1f %8d' % (name, codec_name,
+                        encode * 1000 / loops, decode * 1000 / loops, len (data))
+
+def percentile (values, p):
+    values = sorted (values)
+    if not values:
+        return 0.0
+    return values[min (int (len (values) * p / 100.0), len (values) - 1)]
+
+def bench_matchmaking ():
+    """
+    Load test of the matchmaker: hundreds of concurrent joins filling rooms,
+    with and without seat counters evicted from memcache along the way.
+    Reports how full the rooms got, the rooms filled past max_players, the
+    joins handed a room before it was created, and the join latency
+    """
+    from google.appengine.api import memcache
+    from matchmaking import Matchmaker
+
+    max_players = 5
+    print '%8s %7s %7s %7s %10s %8s %10s %10s %8s' % ('joins', 'evict', 'rooms', 'fill',
+                                                      'overfull', 'unborn', 'p50 (ms)',
+                                                      'p99 (ms)', 'errors')
+    for joins in (100, 300, 600):
+        for evict in (False, True):
+            memcache.flush_all ()
+            matchmaker = Matchmaker ('BenchRoom')
+            seats = {}
+            created = set ()
+            unborn = []
+            latencies = []
+            errors = []
+            lock = threading.Lock ()
+            start_gate = threading.Event ()
+            def create (room):
+                #   about what storing the room takes
+                time.sleep (0.005)
+                created.add (room)
+            def join ():
+                start_gate.wait ()
+                start = time.time ()
+                try:
+                    room, seat, is_new = matchmaker.reserve (max_players, create)
+                except Exception, e:
+                    errors.append (e)
+                    return
+                elapsed = (time.time () - start) * 1000.0
+                lock.acquire ()
+                try:
+                    if room not in created:
+                        unborn.append (room)
+                    seats.setdefault (room, []).append (seat)
+                    latencies.append (elapsed)
+                finally:
+                    lock.release ()
+            def evictor ():
+                start_gate.wait ()
+                while len (latencies) + len (errors) < joins:
+                    for room in matchmaker.open_rooms_list ():
+                        memcache.delete (matchmaker._seats_key (room))
+                    time.sleep (0.001)
+            threads = [threading.Thread (target=join) for i in xrange (joins)]
+            if evict:
+                threads.append (threading.Thread (target=evictor))
+            for t in threads:
+                t.start ()
+            start_gate.set ()
+            for t in threads:
+                t.join ()
+            seated = sum ([len (x) for x in seats.values ()])
+            overfull = len ([x for x in seats.values () if len (x) > max_players])
+            fill = seated / float (len (seats) * max_players or 1)
+            print '%8d %7s %7d %7.2f %10d %8d %10.2f %10.2f %8d' % (
+                    joins, evict and 'yes' or 'no', len (seats), fill, overfull, len (unborn),
+                    percentile (latencies, 50), percentile (latencies, 99), len (errors))
+
+def bench_identitymap ():
+    """
+    memcache and datastore calls made by the chat and join flows, with and
+    without a unit of work around them
+    """
+    import identitymap
+    from tournament2 import DeathMatch, Player, store_entities
+
+    def in_unit_of_work (fn):
+        def run ():
+            unit = identitymap.begin ()
+            try:
+                fn ()
+                unit.commit (store_entities)
+            finally:
+                identitymap.end ()
+        return run
+
+    players = [0]
+    def join ():
+        players[0] += 1
+        player = Player.from_id ('bench-join-%d' % players[0])
+        player.create_channel ()
+        DeathMatch.join_latest_or_new (player)
+    def chat ():
+        Player.from_id ('bench-join-1').chat ('hello')
+
+    print '%-8s %-14s %10s %10s' % ('flow', 'unit of work', 'memcache', 'datastore')
+    for name, flow in (('join', join), ('chat', chat)):
+        for unit, fn in (('no', flow), ('yes', in_unit_of_work (flow))):
+            calls = count_rpcs (fn)
+            print '%-8s %-14s %10d %10d' % (name, unit, calls.get ('memcache', 0),
+                                            calls.get ('datastore_v3', 0))
+
+def bench_rounds ():
+    """
+    One tick of the round scheduler with 100, 1000 and 3000 rooms due at
+    once: time taken and API calls made. Then a room filled in the middle
+    of a tick, which has to start with the next one
+    """
+    import rounds
+    from google.appengine.api import memcache
+    from tournament2 import DeathMatch, store_entities
+
+    now = time.time ()
+    print '%8s %12s %10s %10s %10s' % ('rooms', 'tick (ms)', 'memcache', 'datastore', 'tasks')
+    for n in (100, 1000, 3000):
+        rooms = [DeathMatch (key_name='bench-round-%d-%d' % (n, i),
+                             players=['a', 'b'], active=True, deadline=now)
+                 for i in xrange (n)]
+        store_entities (rooms)
+        rounds.schedule ([x.keyname for x in rooms], now)
+        memcache.delete (rounds.LAST_TICK_KEY)
+        def tick ():
+            rounds.tick (DeathMatch.advance_rooms, now + rounds.TICK)
+        start = time.time ()
+        calls = count_rpcs (tick)
+        elapsed = (time.time () - start) * 1000.0
+        print '%8d %12.2f %10d %10d %10d' % (n, elapsed, calls.get ('memcache', 0),
+                                             calls.get ('datastore_v3', 0),
+                                             calls.get ('taskqueue', 0))
+
+    #   A room filling up in the middle of a tick, once the task of the tick
+    #   has run: it has to start with the next tick
+    now = time.time ()
+    room = DeathMatch (key_name='bench-round-filled', players=['a', 'b'])
+    memcache.set (rounds.LAST_TICK_KEY, rounds.tick_of (now))
+    room.schedule (now)
+    store_entities ([room])
+    rounds.tick (DeathMatch.advance_rooms, now + rounds.TICK)
+    started = DeathMatch.from_id (room.keyname).active
+    print 'room filled mid-tick: %s' % (started and 'started at the next tick' or 'NOT STARTED')
+
+def bench_powerups ():
+    """
+    Many players acting every round: using a powerup and reading their
+    attack, with the definitions scanned on every action and with the
+    compiled tables
+    """
+    import random
+    import powerups
+    from tournament2 import BasePowerup
+
+    definitions = [BasePowerup (name='powerup-%d' % i,
+                                acts_on=powerups.STATS[i % 3],
+                                power_factor=10 + i,
+                                multiple_usage=bool (i % 2), max_usage=5,
+                                active_time=1 + i % 4, refills_in=2 + i % 6,
+                                refill=bool (i % 5), enabled_after=i % 3)
+                   for i in xrange (20)]
+    names = [x.name for x in definitions]
+
+    def scan_state (name, game_round, used):
+        for d in definitions:
+            if d.name != name:
+                continue
+            if game_round < d.enabled_after:
+                return powerups.DISABLED
+            if used is None:
+                return powerups.READY
+            since = game_round - used[0]
+            if since < d.active_time:
+                return powerups.ACTIVE
+            if d.refill and since < d.refills_in:
+                return powerups.REFILLING
+            if not d.refill or used[1] >= (d.multiple_usage and d.max_usage or 1):
+                return powerups.SPENT
+            return powerups.READY
+
+    def scan_attack (value, game_round, usage):
+        bonus = 0
+        for name, used in usage.items ():
+            for d in definitions:
+                if (d.name == name and d.acts_on == 'attack'
+                        and scan_state (name, game_round, used) == powerups.ACTIVE):
+                    bonus += d.power_factor
+        return value + value * bonus / 100
+
+    def play (state, attack, players, rounds):
+        rnd = random.Random (1)
+        usage = [{} for i in xrange (players)]
+        for game_round in xrange (1, rounds + 1):
+            for p in xrange (players):
+                name = names[rnd.randint (0, len (names) - 1)]
+                if state (name, game_round, usage[p].get (name)) == powerups.READY:
+                    used = usage[p].get (name)
+                    usage[p][name] = (game_round, (used and used[1] or 0) + 1)
+                attack (10, game_round, usage[p])
+
+    table = powerups.PowerupTable (definitions)
+    rounds = 20
+    print '%8s %14s %14s' % ('players', 'scan (ms)', 'tables (ms)')
+    for players in (100, 1000, 5000):
+        scan = timeit (lambda: play (scan_state, scan_attack, players, rounds), repeat=1)
+        compiled = timeit (lambda: play (
+                lambda n, r, used: table.powerups[n].state (r, used),
+                lambda v, r, usage: table.apply ('attack', v, r, usage),
+                players, rounds), repeat=1)
+        print '%8d %14.2f %14.2f' % (players, scan, compiled)
+
+def bench_render ():
+    """
+    Render time of the page MainPage.get serves: compiling index.html on
+    every call as before, and from the compiled template cache
+    """
+    import templates
+    from google.appengine.ext.webapp import template
+
+    path = os.path.join (ROOT, 'index.html')
+    loops = 200
+    def values ():
+        return {'token' : 'x' * 40, 'userid' : 'bench', 'gamekey' : 'room',
+                'logout_url' : '/bye'}
+    uncached = timeit (lambda: [template.render (path, values (), debug=True)
+                                for i in xrange (loops)])
+    cached = timeit (lambda: [templates.render ('index.html', values ())
+                              for i in xrange (loops)])
+    print '%-12s %12s' % ('render', 'ms/page')
+    print '%-12s %12.3f' % ('compiled', uncached / loops)
+    print '%-12s %12.3f' % ('cached', cached / loops)
+
+def bench_scrollback ():
+    """
+    Join latency, as the snapshot a joining player is sent, for rooms with
+    a long chat history: decoding a room carrying the legacy chat blob
+    against reading the recent chat ring. Then the ring lost and rebuilt by
+    an append, which has to keep the new line once
+    """
+    from google.appengine.api import memcache
+    from chat import ChatLog, RecentChat
+    from tournament2 import DeathMatch, serialize_entities, deserialize_entities
+
+    line = 'x' * 60
+    print '%10s %16s %16s %16s' % ('history', 'blob room (ms)', 'snapshot (ms)', 'cold ring (ms)')
+    for history in (100, 10000, 100000):
+        name = 'bench-scrollback-%d' % history
+        blob = serialize_entities (DeathMatch (key_name=name, chat=line * history))
+        room = DeathMatch (key_name=name)
+        #   only the last segments are written, that is all a join reads
+        room.chat_tail = max (history - 300, 0)
+        for i in xrange (history - room.chat_tail):
+            room.chat_tail = ChatLog.append (name, room.chat_tail, 'bench', line)
+        legacy = timeit (lambda: deserialize_entities (blob).chat[-RECENT_CHARS:])
+        snapshot = timeit (room.snapshot)
+        def cold ():
+            memcache.delete (str (RecentChat (key_name=name).key ()))
+            room.snapshot ()
+        print '%10d %16.3f %16.3f %16.3f' % (history, legacy, snapshot, timeit (cold))
+
+    #   The ring lost and a line appended: it is built again from the log,
+    #   with the new line once
+    name = 'bench-scrollback-lost'
+    tail = 0
+    for i in xrange (10):
+        tail = ChatLog.append (name, tail, 'bench', 'line %d' % i)
+    recent = RecentChat (key_name=name)
+    memcache.delete (recent.keyname)
+    recent.delete ()
+    tail = ChatLog.append (name, tail, 'bench', 'last')
+    copies = len ([x for x in RecentChat.lines (name) if x['chat'] == 'last'])
+    print 'ring lost, then a line appended: %s' % (
+            copies == 1 and 'line kept once' or 'LINE KEPT %d TIMES' % copies)
+
+#   What a join used to show of the legacy blob
+RECENT_CHARS = 50 * 60
+
+def bench_contention ():
+    """
+    Concurrent writers updating one hot room through the cache: updates
+    made, updates lost, compare-and-set retries and merges, and throughput
+    """
+    import metrics
+    from tournament2 import DeathMatch, get2, store_entities
+
+    updates = 20
+    print '%8s %8s %6s %9s %8s %12s' % ('writers', 'updates', 'lost', 'retries',
+                                        'merges', 'updates/s')
+    for writers in (2, 10, 50):
+        room = DeathMatch (key_name='bench-contention-%d' % writers)
+        store_entities ([room])
+        key = room.key ()
+        start_gate = threading.Event ()
+        def write (writer):
+            start_gate.wait ()
+            for i in xrange (updates):
+                room = get2 (key)
+                room.players.append ('writer-%d-%d' % (writer, i))
+                store_entities ([room])
+        before = metrics.local_report ()['counters']
+        threads = [threading.Thread (target=write, args=(i,)) for i in xrange (writers)]
+        for t in threads:
+            t.start ()
+        start = time.time ()
+        start_gate.set ()
+        for t in threads:
+            t.join ()
+        elapsed = time.time () - start
+        after = metrics.local_report ()['counters']
+        stored = get2 (key)
+        total = writers * updates
+        print '%8d %8d %6d %9d %8d %12.1f' % (writers, total, total - len (stored.players),
+                    after.get ('cas.retry', 0) - before.get ('cas.retry', 0),
+                    after.get ('cas.merge', 0) - before.get ('cas.merge', 0),
+                    total / elapsed)
+
+def bench_writebehind ():
+    """
+    One bucket of 10, 100 and 1000 dirty rooms flushed to the datastore,
+    one of them deleted meanwhile and cached as missing: rooms written, API
+    calls made and time taken. The missing room is skipped, not an error
+    """
+    from google.appengine.api import memcache
+    from tournament2 import DeathMatch, MISSING, serialize_entities, write_behind
+
+    print '%8s %8s %10s %10s %10s %8s' % ('dirty', 'flushed', 'memcache', 'datastore',
+                                         'ms', 'errors')
+    for n in (10, 100, 1000):
+        rooms = [DeathMatch (key_name='bench-flush-%d-%d' % (n, i)) for i in xrange (n)]
+        cached = dict ((str (x.key ()), serialize_entities (x)) for x in rooms)
+        cached[str (rooms[0].key ())] = MISSING
+        memcache.set_multi (cached)
+        bucket, slots = write_behind.dirty.add_multi (cached.keys ())
+        flushed = [0]
+        errors = []
+        def flush ():
+            try:
+                flushed[0] = write_behind.flush_bucket (bucket)
+            except Exception, e:
+                errors.append (e)
+        start = time.time ()
+        calls = count_rpcs (flush)
+        elapsed = (time.time () - start) * 1000.0
+        print '%8d %8d %10d %10d %10.2f %8d' % (n, flushed[0], calls.get ('memcache', 0),
+                                               calls.get ('datastore_v3', 0), elapsed,
+                                               len (errors))
+
+def bench_broadcast ():
+    """
+    Cost of one broadcast of home.Tournament to rooms of growing size: the
+    API calls made, by service, and the latency. Reads only, none of them
+    grows with the room
+    """
+    from google.appengine.api import memcache
+    from home import Game, PlayerGame, Tournament, serialize_entities
+
+    print '%8s %10s %10s %10s %10s' % ('players', 'memcache', 'datastore', 'channel', 'ms')
+    for players in (2, 20, 100):
+        room = 'bench-broadcast-%d' % players
+        userids = ['%s-%d' % (room, i) for i in xrange (players)]
+        game = Game (key_name=room, players=userids)
+        game.put ()
+        memcache.set_multi (dict ((x, serialize_entities (PlayerGame (key_name=x, parent=game,
+                                                                      channels=[x])))
+                                  for x in userids))
+        tournament = Tournament (room)
+        tournament.updates = {'delta_chat' : 'bench'}
+        tournament.get_tournament ()
+        calls = count_rpcs (tournament.send_update)
+        print '%8d %10d %10d %10d %10.3f' % (players, calls.get ('memcache', 0),
+                                             calls.get ('datastore_v3', 0),
+                                             calls.get ('channel', 0),
+                                             timeit (tournament.send_update))
+
+def bench_ignores ():
+    """
+    Cost of leaving out, when a message is sent to a room of 100 channels,
+    the players who ignore the sender: the API calls made and the latency,
+    for ignore lists kept as a plain set and as a Bloom filter
+    """
+    from google.appengine.ext import db
+    import ignores
+
+    recipients = ['ignores-player-%d' % i for i in xrange (100)]
+    channels = ['ignores-channel-%d' % i for i in xrange (100)]
+    owners = dict (zip (channels, recipients))
+    print '%10s %8s %10s %10s %8s %10s' % ('ignorers', 'kind', 'memcache',
+                                           'datastore', 'dropped', 'ms')
+    for size in (10, ignores.EXACT_LIMIT * 5):
+        sender = 'ignores-sender-%d' % size
+        #   every tenth recipient ignores the sender, the rest are strangers
+        users = recipients[::10] + ['ignores-other-%d' % i for i in xrange (size - 10)]
+        pairs = [ignores.IgnorePair (key_name=ignores.IgnorePair.key_name_for (x, sender),
+                                     user=x, ignored=sender) for x in users]
+        for i in xrange (0, len (pairs), 500):
+            db.put (pairs[i:i + 500])
+        ignores.ignored_by ([sender])
+        kept = []
+        calls = count_rpcs (lambda: kept.extend (ignores.recipients (sender, channels, owners)))
+        kind = isinstance (ignores.ignored_by ([sender])[sender], set) and 'set' or 'bloom'
+        print '%10d %8s %10d %10d %8d %10.3f' % (size, kind, calls.get ('memcache', 0),
+                                                 calls.get ('datastore_v3', 0),
+                                                 len (channels) - len (kept),
+                                                 timeit (lambda: ignores.recipients (sender, channels, owners)))
+
+BENCHMARKS = {
+    'broadcast' : bench_broadcast,
+    'channel_send' : bench_channel_send,
+    'chatlog' : bench_chatlog,
+    'codec' : bench_codec,
+    'contention' : bench_contention,
+    'fanout' : bench_fanout,
+    'get2' : bench_get2,
+    'identitymap' : bench_identitymap,
+    'ignores' : bench_ignores,
+    'matchmaking' : bench_matchmaking,
+    'powerups' : bench_powerups,
+    'render' : bench_render,
+    'rounds' : bench_rounds,
+    'scrollback' : bench_scrollback,
+    'writebehind' : bench_writebehind,
+}
+
+def main (names):
+    tb = setup_testbed ()
+    try:
+        for name in names or sorted (BENCHMARKS):
+            print '== %s' % name
+            BENCHMARKS[name] ()
+    finally:
+        tb.deactivate ()
+
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
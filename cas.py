@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Read-modify-write of memcache values with compare-and-set.
+#
+#   The value is read with gets, changed and written back with cas, which
+#   fails when somebody else wrote the value in between; the change is then
+#   made again on the newer value, up to CAS_RETRIES times. Only when all
+#   the retries are used up is the value overwritten with a plain set, and
+#   the loss logged.
+
+import logging
+
+from google.appengine.api import memcache
+
+import metrics
+
+CAS_RETRIES = 10
+
+def update (key, modify, load, encode, decode, time=0):
+    """
+    Applies modify to the value of key and stores the result. load returns
+    the value when memcache has none. modify returns the new value, or None
+    to leave the value alone. Returns the new value.
+    """
+    client = memcache.Client ()
+    for attempt in xrange (CAS_RETRIES):
+        data = client.gets (key)
+        if data is None:
+            value = modify (load ())
+            if value is None or client.add (key, encode (value), time=time):
+                break
+        else:
+            value = modify (decode (data))
+            if value is None or client.cas (key, encode (value), time=time):
+                break
+        metrics.incr ('cas.retry')
+    else:
+        logging.warning ('Could not compare-and-set %s, overwriting it' % key)
+        metrics.incr ('cas.exhausted')
+        client.set (key, encode (value), time=time)
+    return value
@@ -1,12 +1,225 @@
 import cgi
+import datetime
 
 from google.appengine.api import users
+from google.appengine.api import memcache
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.ext import db
 
+from codec import serialize_entities, deserialize_entities
+import cas
+
+#   Number of chat lines stored in one segment of the log
+SEGMENT_SIZE = 100
+
+#   A segment is written to memcache on every line but to the datastore only
+#   on every FLUSH_EVERY lines and when it gets full. Same trade off as the
+#   FAULT_TOLERANCE of the versioned caching models.
+FLUSH_EVERY = 4
+
+#   The recent chat of a room is bounded by both number of lines and size
+RECENT_LINES = 50
+RECENT_BYTES = 8 * 1024
+
+def as_lines(authors, texts, dates):
+    return [{'player' : author,
+             'chat' : text,
+             'date' : date.isoformat()}
+            for author, text, date in zip(authors, texts, dates)]
+
 class ChatLog(db.Model):
-    author = db.StringProperty()
+    """
+    Append-only chat log of a room, stored as fixed-size segments.
+
+    Line number n of a room lives in segment n / SEGMENT_SIZE, so appending
+    a line only ever touches the last segment and costs the same whether the
+    room has 10 or 100,000 lines. The room keeps the number of lines written
+    so far (the tail) and readers page through the segments backwards from it.
+    """
     room = db.StringProperty()
-    text = db.TextProperty(multiline=True)
-    date = db.DateTimeProperty(auto_now_add=True)
+    segment = db.IntegerProperty(default=0)
+    authors = db.StringListProperty()
+    texts = db.ListProperty(db.Text)
+    dates = db.ListProperty(datetime.datetime)
+
+    @staticmethod
+    def key_name_for(room, segment):
+        return '%s/%d' % (room, segment)
+
+    @staticmethod
+    def segment_of(line):
+        return line / SEGMENT_SIZE
+
+    @property
+    def keyname(self):
+        return str(self.key())
+
+    @classmethod
+    def get_segments(cls, room, segments):
+        """
+        Returns the segments of the room in the order asked for, None for the
+        ones which were never written. One memcache and at most one datastore
+        round trip.
+        """
+        keys = [db.Key.from_path(cls.kind(), cls.key_name_for(room, x))
+                for x in segments]
+        cached = memcache.get_multi(map(str, keys))
+        missing = [k for k in keys if str(k) not in cached]
+        found = {}
+        if missing:
+            for entity in db.get(missing):
+                if entity is not None:
+                    found[str(entity.key())] = entity
+        ret = []
+        for key in keys:
+            data = cached.get(str(key))
+            if data is not None:
+                ret.append(deserialize_entities(data))
+            else:
+                ret.append(found.get(str(key)))
+        if found:
+            memcache.set_multi(dict((k, serialize_entities(v))
+                                    for k, v in found.items()))
+        return ret
+
+    @classmethod
+    def append(cls, room, tail, author, text):
+        """
+        Writes `text` after line number `tail` of the room and returns the new
+        tail. The segment and the recent chat are changed with compare-and-set,
+        so concurrent appends to a room all make it, one after the other.
+        """
+        now = datetime.datetime.now()
+        def add_line(log):
+            if len(log.texts) >= SEGMENT_SIZE:
+                return None
+            log.authors.append(author)
+            log.texts.append(db.Text(text))
+            log.dates.append(now)
+            return log
+        while True:
+            segment = cls.segment_of(tail)
+            key = db.Key.from_path(cls.kind(), cls.key_name_for(room, segment))
+            def load():
+                return db.get(key) or cls(key_name=key.name(), room=room,
+                                          segment=segment)
+            log = cas.update(str(key), add_line, load,
+                             serialize_entities, deserialize_entities)
+            if log is not None:
+                break
+            #   Filled up by concurrent appends, go on with the next one
+            tail = (segment + 1) * SEGMENT_SIZE
+        lines = len(log.texts)
+        new_tail = segment * SEGMENT_SIZE + lines
+        def push(recent):
+            recent.push(author, text, now)
+            return recent
+        recent_key = db.Key.from_path(RecentChat.kind(), room)
+        recent = cas.update(str(recent_key), push,
+                            lambda: db.get(recent_key) or RecentChat.rebuild(room, new_tail - 1),
+                            serialize_entities, deserialize_entities)
+        if lines == 1 or lines % FLUSH_EVERY == 0 or lines == SEGMENT_SIZE:
+            db.put([log, recent])
+        return new_tail
+
+    @classmethod
+    def read(cls, room, tail, segment=None):
+        """
+        Returns one page of the room's chat, the last segment by default, as
+        a dict with the lines and the number of the previous segment.
+        """
+        if segment is None:
+            segment = cls.segment_of(max(tail - 1, 0))
+        log = cls.get_segments(room, [segment])[0]
+        previous = None
+        if segment > 0:
+            previous = segment - 1
+        return {'segment' : segment,
+                'previous' : previous,
+                'lines' : log and log.as_lines() or []}
+
+    def as_lines(self):
+        return as_lines(self.authors, self.texts, self.dates)
+
+class RecentChat(db.Model):
+    """
+    The last lines of the chat of a room, at most RECENT_LINES of them and
+    RECENT_BYTES of text, kept as a ring: pushing a line drops the oldest
+    ones over the bounds.
+
+    It is written along with the room's ChatLog and lets a player who joins
+    or comes back get the recent scrollback with one memcache get, without
+    loading the room or paging through the log. Key name is the room.
+    """
+    authors = db.StringListProperty()
+    texts = db.ListProperty(db.Text)
+    dates = db.ListProperty(datetime.datetime)
+
+    @property
+    def keyname(self):
+        return str(self.key())
+
+    @classmethod
+    def load(cls, room):
+        """
+        The recent chat of the room, from memcache or else the datastore.
+        None when there is none.
+        """
+        key = db.Key.from_path(cls.kind(), room)
+        data = memcache.get(str(key))
+        if data is not None:
+            return deserialize_entities(data)
+        recent = db.get(key)
+        if recent is not None:
+            memcache.set(str(key), serialize_entities(recent))
+        return recent
+
+    @classmethod
+    def rebuild(cls, room, tail):
+        """
+        Builds the recent chat of the room again from the last lines of its
+        log before line number `tail`. Lines written after it are left out
+        """
+        recent = cls(key_name=room)
+        if tail > 0:
+            last = ChatLog.segment_of(tail - 1)
+            segments = range(max(last - RECENT_LINES / SEGMENT_SIZE - 1, 0), last + 1)
+            for segment, log in zip(segments, ChatLog.get_segments(room, segments)):
+                if log is not None:
+                    count = tail - segment * SEGMENT_SIZE
+                    for line in zip(log.authors, log.texts, log.dates)[:count]:
+                        recent.push(*line)
+        return recent
+
+    @classmethod
+    def lines(cls, room, tail=None):
+        """
+        The recent lines of the room's chat, oldest first. When the recent
+        chat is lost and the room's tail is given, it is built again
+        """
+        recent = cls.load(room)
+        if recent is None and tail:
+            recent = cls.rebuild(room, tail)
+            memcache.set(recent.keyname, serialize_entities(recent))
+        if recent is None:
+            return []
+        return recent.as_lines()
+
+    def push(self, author, text, date):
+        self.authors.append(author)
+        self.texts.append(db.Text(text))
+        self.dates.append(date)
+        size = sum(map(len, self.texts))
+        drop = 0
+        while len(self.texts) - drop > RECENT_LINES or \
+                (size > RECENT_BYTES and len(self.texts) - drop > 1):
+            size -= len(self.texts[drop])
+            drop += 1
+        if drop:
+            self.authors = self.authors[drop:]
+            self.texts = self.texts[drop:]
+            self.dates = self.dates[drop:]
+
+    def as_lines(self):
+        return as_lines(self.authors, self.texts, self.dates)
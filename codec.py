@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Serialization of cached entities.
+#
+#   Entities used to be cached as their encoded protobuf, which is costly to
+#   build and parse on every hot path read and grows large with the chat and
+#   channel lists. The compact codec marshals a tuple of (tag, value) pairs
+#   instead, the tag of a field being a hash of its name, and compresses the
+#   result once it gets over COMPRESS_THRESHOLD bytes.
+#
+#   A compact blob starts with MAGIC and a format byte holding the format
+#   version and the compression flag. MAGIC can never start an encoded
+#   protobuf, so blobs cached before the codec existed are still read.
+#
+#   Models have to be imported before their entities can be decoded, just
+#   like with db.model_from_protobuf.
+
+import calendar
+import datetime
+import marshal
+import zlib
+
+from google.appengine.ext import db
+
+from google.appengine.datastore import entity_pb
+
+#   Field number 28 with the invalid wire type 7, never the first byte of a
+#   protobuf
+MAGIC = '\xe7'
+FORMAT_VERSION = 1
+COMPRESSED = 0x80
+
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 1
+
+def _plain (value):
+    """
+    Values of the datastore types which are subclasses of the builtin ones,
+    as the builtin type marshal knows of
+    """
+    if isinstance (value, unicode):
+        return unicode (value)
+    if isinstance (value, str):
+        return str (value)
+    return value
+
+def _datetime_to_raw (value):
+    if value is None:
+        return None
+    return calendar.timegm (value.timetuple ()) * 1000000 + value.microsecond
+
+def _datetime_from_raw (raw):
+    if raw is None:
+        return None
+    return datetime.datetime.utcfromtimestamp (raw / 1000000) + \
+                        datetime.timedelta (microseconds=raw % 1000000)
+
+def _key_to_raw (value):
+    if value is None:
+        return None
+    return str (value)
+
+def _key_from_raw (raw):
+    if raw is None:
+        return None
+    return db.Key (raw)
+
+def _identity (value):
+    return value
+
+def _construct (data_type):
+    def from_raw (raw):
+        if raw is None:
+            return None
+        return data_type (raw)
+    return from_raw
+
+def _list_of (convert):
+    def converter (values):
+        if values is None:
+            return None
+        return [convert (x) for x in values]
+    return converter
+
+def _converters (prop):
+    """
+    Returns the functions turning the value of a property into something
+    marshal can encode and back
+    """
+    if isinstance (prop, db.ReferenceProperty):
+        data_type = db.Key
+    elif isinstance (prop, db.ListProperty):
+        data_type = prop.item_type
+    else:
+        data_type = prop.data_type
+    if data_type is datetime.datetime:
+        to_raw, from_raw = _datetime_to_raw, _datetime_from_raw
+    elif data_type is db.Key:
+        to_raw, from_raw = _key_to_raw, _key_from_raw
+    elif issubclass (data_type, basestring) and \
+                        data_type not in (basestring, str, unicode):
+        #   db.Text, db.Blob and the like
+        to_raw, from_raw = _plain, _construct (data_type)
+    else:
+        to_raw, from_raw = _plain, _identity
+    if isinstance (prop, db.ListProperty):
+        return _list_of (to_raw), _list_of (from_raw)
+    return to_raw, from_raw
+
+def field_tag (name):
+    return zlib.crc32 (name) & 0xffff
+
+#   Field tables of the model classes, built once per process
+_tables = {}
+
+class FieldTable (object):
+    """
+    The tags of the fields of a model class and how to encode their values
+    """
+    def __init__ (self, model_class):
+        self.model_class = model_class
+        self.fields = []
+        self.by_tag = {}
+        for name, prop in sorted (model_class.properties ().items ()):
+            tag = field_tag (name)
+            if tag in self.by_tag:
+                raise ValueError ('Fields %s and %s of %s have the same tag' % (
+                            name, self.by_tag[tag][0], model_class.kind ()))
+            to_raw, from_raw = _converters (prop)
+            self.fields.append ((tag, prop, to_raw))
+            self.by_tag[tag] = (name, from_raw)
+
+def field_table (model_class):
+    table = _tables.get (model_class)
+    if table is None:
+        table = _tables[model_class] = FieldTable (model_class)
+    return table
+
+class ProtobufCodec (object):
+    """
+    The encoded entity protobuf, the way entities used to be cached
+    """
+    def encode (self, model):
+        return db.model_to_protobuf (model).Encode ()
+
+    def decode (self, data):
+        return db.model_from_protobuf (entity_pb.EntityProto (data))
+
+class CompactCodec (object):
+    """
+    Field tagged marshal of the entity, compressed when large
+    """
+    def __init__ (self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.level = level
+
+    def encode (self, model):
+        table = field_table (model.__class__)
+        fields = []
+        for tag, prop, to_raw in table.fields:
+            fields.append (tag)
+            fields.append (to_raw (prop.get_value_for_datastore (model)))
+        data = marshal.dumps ((model.kind (), str (model.key ()), tuple (fields)))
+        if len (data) > self.threshold:
+            return MAGIC + chr (FORMAT_VERSION | COMPRESSED) + \
+                                zlib.compress (data, self.level)
+        return MAGIC + chr (FORMAT_VERSION) + data
+
+    def decode (self, data):
+        flags = ord (data[1])
+        if flags & ~COMPRESSED != FORMAT_VERSION:
+            raise ValueError ('Unknown cache format version %d' % (flags & ~COMPRESSED))
+        data = data[2:]
+        if flags & COMPRESSED:
+            data = zlib.decompress (data)
+        kind, key, fields = marshal.loads (data)
+        table = field_table (db.class_for_kind (kind))
+        values = {}
+        for i in xrange (0, len (fields), 2):
+            field = table.by_tag.get (fields[i])
+            if field is None:
+                #   the field was removed from the model since
+                continue
+            name, from_raw = field
+            values[name] = from_raw (fields[i + 1])
+        return table.model_class (None, _from_entity=True, key=db.Key (key), **values)
+
+protobuf_codec = ProtobufCodec ()
+compact_codec = CompactCodec ()
+
+_codec = compact_codec
+
+def set_codec (codec):
+    """
+    Changes the codec new blobs are written with and returns the old one.
+    Blobs of both formats are always read.
+    """
+    global _codec
+    old, _codec = _codec, codec
+    return old
+
+def encode (model):
+    return _codec.encode (model)
+
+def decode (data):
+    if data[:1] == MAGIC:
+        return compact_codec.decode (data)
+    return protobuf_codec.decode (data)
+
+def serialize_entities (models):
+    if models is None:
+        return None
+    elif isinstance (models, db.Model):
+        return encode (models)
+    else:
+        return [encode (x) for x in models]
+
+def deserialize_entities (data):
+    if data is None:
+        return None
+    elif isinstance (data, str):
+        return decode (data)
+    else:
+        return [decode (x) for x in data]
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Sequence numbered stream of the updates (deltas) of a room.
+#
+#   Every delta sent to a room gets the next sequence number of the room,
+#   handed out by an atomic memcache incr, and is kept in a ring buffer of
+#   the last RING_SIZE deltas in memcache. A client which reconnects tells
+#   the last sequence number it has seen and gets only the deltas it missed,
+#   read with one get_multi. When it missed more than the ring holds, or the
+#   ring lost some of them, it has to be sent a full snapshot instead.
+
+from google.appengine.api import memcache
+
+RING_SIZE = 64
+RING_TTL = 60 * 60
+
+class DeltaStream (object):
+
+    def __init__ (self, room):
+        self.room = room
+
+    def _seq_key (self):
+        return 'seq:%s' % self.room
+
+    def _slot_key (self, seq):
+        return 'delta:%s:%d' % (self.room, seq % RING_SIZE)
+
+    def current (self, known=0):
+        """
+        The sequence number of the last delta of the room. `known` is the
+        last one persisted with the room, for when memcache lost the counter
+        """
+        seq = memcache.get (self._seq_key ())
+        if seq is None:
+            return known
+        return max (int (seq), known)
+
+    def publish (self, delta, known=0):
+        """
+        Numbers the delta and keeps it in the ring. Returns the delta with
+        its sequence number as 'seq'.
+        """
+        seq = memcache.incr (self._seq_key (), initial_value=known)
+        delta = dict (delta)
+        delta['seq'] = seq
+        if seq is not None:
+            memcache.set (self._slot_key (seq), delta, time=RING_TTL)
+        return delta
+
+    def since (self, last_seq, known=0):
+        """
+        The deltas after last_seq, oldest first, or None when they are not
+        all in the ring any more and a snapshot has to be sent instead
+        """
+        current = self.current (known)
+        if last_seq == current:
+            return []
+        if last_seq > current or current - last_seq > RING_SIZE:
+            return None
+        seqs = range (last_seq + 1, current + 1)
+        found = memcache.get_multi ([self._slot_key (x) for x in seqs])
+        deltas = []
+        for seq in seqs:
+            delta = found.get (self._slot_key (seq))
+            if delta is None or delta.get ('seq') != seq:
+                return None
+            deltas.append (delta)
+        return deltas
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Fan-out of room updates over the Channel API.
+#
+#   Small rooms are served inline, within the request that produced the
+#   update. Bigger rooms are split into batches of channels and every batch
+#   is handed over to a worker task, so the latency of a chat or join request
+#   does not grow with the number of people sitting in the room.
+#
+#   Within a batch, the sends are asynchronous RPCs with up to IN_FLIGHT of
+#   them running at a time, so the batch takes about as long as its slowest
+#   send rather than the sum of all of them. A failed send is only recorded
+#   against its channel.
+#
+#   A batch is cut short of BATCH_SIZE channels when its payload would
+#   grow past MAX_PAYLOAD bytes. A message too big to leave room for the
+#   channels is stored once in memcache, and the payloads only carry its key.
+#
+#   The queue the batches go to is pluggable. On App Engine it is the task
+#   queue, in benchmarks and local runs it is a LocalQueue which keeps the
+#   payloads in process memory and runs them on demand.
+
+import hashlib
+import logging
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import channel
+from google.appengine.api import channel_service_pb
+from google.appengine.runtime import apiproxy_errors
+from google.appengine.runtime import api_base_pb
+
+import lazy
+import metrics
+import presence
+
+FANOUT_QUEUE = 'fanout'
+FANOUT_URL = '/tasks/fanout'
+
+#   Only rooms too big to be served inline need these
+simplejson = lazy.module ('django.utils.simplejson')
+taskqueue = lazy.module ('google.appengine.api.taskqueue')
+
+#   Number of channels a single worker task sends to, at most
+BATCH_SIZE = 25
+
+#   Bytes of a task payload, below the 10KB task size limit with room for
+#   the headers
+MAX_PAYLOAD = 9 * 1024
+
+#   Seconds a message too big for the payloads is kept for the batches
+MESSAGE_TTL = 10 * 60
+
+#   Queue.add accepts at most this many tasks in one call
+MAX_TASKS_PER_ADD = 100
+
+IN_FLIGHT = 20          # send RPCs running at the same time
+SEND_DEADLINE = 5       # seconds a single send may take
+
+def batches (channel_ids, size=BATCH_SIZE, room=None):
+    """
+    Splits the list of channel ids into lists of at most `size` ids, and of
+    at most `room` bytes of ids as encoded in a payload
+    """
+    batch = []
+    used = 0
+    for channel_id in channel_ids:
+        cost = len (channel_id) + 4     # quotes, comma and space
+        if batch and (len (batch) >= size or (room is not None and used + cost > room)):
+            yield batch
+            batch = []
+            used = 0
+        batch.append (channel_id)
+        used += cost
+    if batch:
+        yield batch
+
+def _send_rpc (channel_id, message):
+    """
+    Starts an asynchronous send of the message on the channel
+    """
+    request = channel_service_pb.SendMessageRequest ()
+    request.set_application_key (channel_id)
+    request.set_message (message)
+    rpc = apiproxy_stub_map.UserRPC (channel._GetService (), deadline=SEND_DEADLINE)
+    rpc.make_call ('SendChannelMessage', request, api_base_pb.VoidProto ())
+    return rpc
+
+def _wait_any (rpcs):
+    """
+    Waits for one of the RPCs to finish and returns it
+    """
+    if hasattr (apiproxy_stub_map.UserRPC, 'wait_any'):
+        rpc = apiproxy_stub_map.UserRPC.wait_any (rpcs)
+        if rpc is not None:
+            return rpc
+    rpcs[0].wait ()
+    return rpcs[0]
+
+def send_many (channel_ids, message, in_flight=IN_FLIGHT):
+    """
+    Sends the message on every channel, keeping up to `in_flight` sends
+    running at a time. Returns the number of channels the message was
+    delivered to and the errors of the others, by channel id.
+    """
+    if isinstance (message, unicode):
+        message = message.encode ('utf-8')
+    pending = list (channel_ids)
+    running = {}
+    failures = {}
+    sent = 0
+    while pending or running:
+        while pending and len (running) < in_flight:
+            channel_id = pending.pop (0)
+            try:
+                running[_send_rpc (channel_id, message)] = channel_id
+            except apiproxy_errors.Error, e:
+                failures[channel_id] = e
+        if not running:
+            break
+        rpc = _wait_any (running.keys ())
+        channel_id = running.pop (rpc)
+        try:
+            rpc.check_success ()
+            sent += 1
+        except apiproxy_errors.ApplicationError, e:
+            failures[channel_id] = channel._ToChannelError (e)
+        except apiproxy_errors.Error, e:
+            failures[channel_id] = e
+    return sent, failures
+
+def send_batch (channel_ids, message):
+    """
+    Sends the message on every channel of the batch. Returns the number of
+    channels the message was delivered to.
+    """
+    sent, failures = send_many (channel_ids, message)
+    dead = []
+    for channel_id, error in failures.items ():
+        logging.info ('Send on %s failed: %r' % (channel_id, error))
+        if isinstance (error, channel.InvalidChannelClientError):
+            dead.append (channel_id)
+    presence.disconnected (dead)
+    metrics.incr ('channel.send', sent)
+    metrics.incr ('channel.failed', len (failures))
+    return sent
+
+def encode_payload (channel_ids, message=None, message_key=None):
+    if message_key is not None:
+        return simplejson.dumps ({'channels' : channel_ids,
+                                  'message_key' : message_key})
+    return simplejson.dumps ({'channels' : channel_ids,
+                              'message' : message})
+
+def process_payload (payload):
+    """
+    Runs one batch. This is what the worker task does with its body.
+    """
+    batch = simplejson.loads (payload)
+    message = batch.get ('message')
+    if 'message_key' in batch:
+        message = memcache.get (batch['message_key'])
+        if message is None:
+            logging.warning ('Fanout message %s is gone from memcache' % batch['message_key'])
+            metrics.incr ('fanout.message_lost')
+            return 0
+    return send_batch (batch['channels'], message)
+
+class TaskQueueBackend (object):
+    """
+    Hands the batches to the App Engine task queue
+    """
+    def __init__ (self, queue_name=FANOUT_QUEUE, url=FANOUT_URL):
+        self.queue_name = queue_name
+        self.url = url
+
+    def enqueue (self, payloads):
+        tasks = [taskqueue.Task (url=self.url, payload=p) for p in payloads]
+        queue = taskqueue.Queue (self.queue_name)
+        for i in xrange (0, len (tasks), MAX_TASKS_PER_ADD):
+            queue.add (tasks[i:i + MAX_TASKS_PER_ADD])
+
+class LocalQueue (object):
+    """
+    In-process stand-in for the task queue. Payloads are kept in memory
+    until run() is called.
+    """
+    def __init__ (self):
+        self.pending = []
+
+    def enqueue (self, payloads):
+        self.pending.extend (payloads)
+
+    def run (self):
+        """
+        Runs all the pending batches and returns the number of messages sent
+        """
+        sent = 0
+        while self.pending:
+            sent += process_payload (self.pending.pop (0))
+        return sent
+
+_backend = TaskQueueBackend ()
+
+def set_backend (backend):
+    """
+    Replaces the queue the batches are sent to and returns the old one
+    """
+    global _backend
+    old, _backend = _backend, backend
+    return old
+
+def dispatch (channel_ids, message, batch_size=BATCH_SIZE):
+    """
+    Splits the channels into batches and enqueues a worker task for each of
+    them, every payload within MAX_PAYLOAD bytes. Returns the number of
+    batches enqueued.
+    """
+    message_key = None
+    overhead = len (encode_payload ([], message))
+    if overhead > MAX_PAYLOAD / 2:
+        #   Stored once rather than in every payload
+        if isinstance (message, unicode):
+            message = message.encode ('utf-8')
+        message_key = 'fanout:message:%s' % hashlib.md5 (message).hexdigest ()
+        memcache.set (message_key, message, time=MESSAGE_TTL)
+        overhead = len (encode_payload ([], message_key=message_key))
+    payloads = [encode_payload (batch, message, message_key)
+                for batch in batches (channel_ids, batch_size, MAX_PAYLOAD - overhead)]
+    _backend.enqueue (payloads)
+    return len (payloads)
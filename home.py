@@ -33,14 +33,18 @@ from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext.webapp import template
 
 from google.appengine.ext.db import TransactionFailedError
 
-from google.appengine.datastore import entity_pb
-
 from django.utils import simplejson
 
+from codec import serialize_entities, deserialize_entities
+
+from chat import ChatLog
+import fanout
+import presence
+import templates
+
 #	The maximum number of participants in the event
 #	Keep it -1 for unlimited access
 
@@ -54,6 +58,9 @@ LATEST_GAMEROOM = 'latest_gameroom'
 #   and memcache are, and higher datastore operations. 4~6
 FAULT_TOLERANCE = 4
 
+#   Channels kept per player, the oldest is dropped when a new one is made
+MAX_PLAYER_CHANNELS = 3
+
 #	There are two entity kinds - Game and PlayerGame
 #
 #	The Game Entity Kind contains information about the game room
@@ -92,7 +99,8 @@ class Game(db.Model):
         game room.
     """
     players = db.StringListProperty()
-    chat    = db.TextProperty()
+    chat    = db.TextProperty()     # legacy, the chat now goes to the ChatLog
+    chat_tail = db.IntegerProperty(default = 0)
     active  = db.BooleanProperty(default = True)
     revision= db.IntegerProperty(default = 0)
     version_in_db = db.IntegerProperty(default = 0)
@@ -115,22 +123,7 @@ class PlayerGame(db.Model):
 
 #   Memcaching of entities effeciently
 #   http://blog.notdot.net/2009/9/Efficient-model-memcaching
-
-def serialize_entities(models):
-    if models is None:
-        return None
-    elif isinstance(models, db.Model):
-        return db.model_to_protobuf(models).Encode()
-    else:
-        return [db.model_to_protobuf(x).Encode() for x in models]
-
-def deserialize_entities(data):
-    if data is None:
-        return None
-    elif isinstance(data, str):
-        return db.model_from_protobuf(entity_pb.EntityProto(data))
-    else:
-        return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
+#   The entities are serialized for memcache by the codec module
 
 def gen_channel(userid):
     seed = userid + str(int(time.time()))
@@ -189,7 +182,7 @@ class Player(object):
         logging.info('Attempting Player sync_to_db')
         if player is not None and player.revision - player.version_in_db >=  FAULT_TOLERANCE:
             player.version_in_db = player.revision
-            memcache_details = deserialize_entities(memcache.get(player.userid))
+            memcache_details = deserialize_entities(memcache.get(self.userid))
             db.put(memcache_details)
             self._store(player)
             logging.info('Player Sync to db complete')
@@ -199,12 +192,23 @@ class Player(object):
     
     def sync_with_db(self):
         "Updates the memcache with values that of datastore"
-        pass
+        logging.info('Attempting Player sync with db')
+        player = PlayerGame.get_by_key_name(self.userid,
+                                            parent = self._get_tournament())
+        if player is None:
+            logging.info('Player not in the datastore, nothing to sync')
+            return False
+        player.revision = player.version_in_db
+        self._player = player
+        memcache.set(self.userid, serialize_entities(player))
+        logging.info('Player sync with db complete')
+        return True
     
     def get_channel(self):
         another_channel = gen_channel(self.userid)
         player = self.get_player()
-        player.channels.append(another_channel)
+        player.channels = player.channels[-(MAX_PLAYER_CHANNELS - 1):] + [another_channel]
+        presence.register(another_channel, self.userid)
         self._store(player)
         return another_channel 
    
@@ -226,16 +230,31 @@ class Player(object):
         # allot him to the latest empty room
             
     def die(self):
-        playergame_key = db.Key.from_path('PlayerGame', self.userid)
-        game = Game.all().filter('user = ', self.userid).get()
+        "The player is gone for good, with its seat in the game room"
+        player = self.get_player()
+        memcache.delete(self.userid)
+        self._player = None
+        if player is None or not player.is_saved():
+            return
+        game_key = player.parent_key()
         
-        def txn(userid, pg_key, g):
+        def txn(userid, pg_key, g_key):
+            if g_key is not None:
+                g = Game.get(g_key)
+                if g is not None and userid in g.players:
+                    g.players.remove(userid)
+                    db.put(g)
             db.delete(pg_key)
-            g.users.pop(userid)
-            db.put(g)
         
-        memcache.delete(self.userid)
-        db.run_in_transaction(txn, self.userid, playergame_key, game_key)
+        db.run_in_transaction(txn, self.userid, player.key(), game_key)
+        if game_key is not None:
+            #   The cached game still seats the player. It may be revisions
+            #   ahead of the datastore, so only the player is taken out of it
+            tournament = Tournament(game_key.name())
+            game = tournament.get_tournament()
+            if game is not None and self.userid in game.players:
+                game.players.remove(self.userid)
+                tournament._store(game)
     
     def get_assets(self):
         return self.assets
@@ -330,14 +349,20 @@ class Tournament(object):
         game = self.get_tournament()
         logging.info('Attempting sync from db')
         if game is not None and game.revision < game.version_in_db:
+            userids = list(game.players)
+            player_keys = [db.Key.from_path('PlayerGame', x, parent = game.key())
+                           for x in userids]
+            #   The game and all its players in one batch get
+            entities = db.get([game.key()] + player_keys)
+            game = entities[0] or game
             game.revision = game.version_in_db
-            player_keys = [db.Key.from_path('Game', 'PlayerGame', x) for x in game.players]
-            memcache_values = serialize_entities(db.get([game.key()].extend(player_keys)))
-            memcache_dict = { self._memcache_key : memcache_values[0] }
-            for x in game.players:
-                memcache_dict[x] = memcache_values[game.players.index(x)]
+            self.game = game
+            memcache_dict = { self._memcache_key : serialize_entities(game) }
+            for userid, player in zip(userids, entities[1:]):
+                if player is not None:
+                    player.revision = player.version_in_db
+                    memcache_dict[userid] = serialize_entities(player)
             memcache.set_multi(memcache_dict)
-            self._store(game)
             logging.info('Sync from db complete')
             return True
         logging.info('Conditions not met to initiate sync from db')
@@ -398,26 +423,22 @@ class Tournament(object):
     @classmethod
     def continue_tournament(cls, player):
         "When the player was already in a tournament continue from there itself"
-        logging.info('Sending message %s on channel %s' %(cls().get_all_updates(),
-                          player.get_channel()))
-        channel.send_message(player.get_channel(), cls().get_all_updates())
+        message = cls().get_all_updates()
+        channel_ids = presence.live(player.active_channels or [])
+        logging.info('Sending message %s on channels %s' %(message, channel_ids))
+        fanout.send_batch(channel_ids, message)
     
     def remove_player(self, player):
         "Marks the end of a player from the tournament"
-        game = self.get_tournament()
-        game.players.pop(player.userid)
-        self._store(game)
         player.die()
+        self.game = None
     
     def chat(self, player, message):
         "Talk folks, talk !!"
         delta_chat = message
         game = self.get_tournament()
-        if game.chat:
-            chat = game.chat + '<br />' + delta_chat
-        else:
-            chat = delta_chat
-        game.chat = chat
+        game.chat_tail = ChatLog.append(self.room, game.chat_tail or 0,
+                                        player.userid, delta_chat)
         self._store(game)
         self.updates.update({'delta_chat' : delta_chat})
         self.send_update()
@@ -439,9 +460,25 @@ class Tournament(object):
         return gen_channel(userid, self.room)
     
     def get_player_channels(self):
-        "Finds out all the channels associated with this tournament"
+        """
+        The live channels of all the players of this tournament. The players
+        are read with one get_multi, and the datastore only for those not in
+        memcache. Nothing is written: broadcasting creates no channels.
+        """
         game = self.get_tournament()
-        return [Player(x).get_channel() for x in game.players]
+        if game is None or not game.players:
+            return []
+        cached = memcache.get_multi(game.players)
+        players = [deserialize_entities(cached[x]) for x in game.players
+                   if x in cached]
+        missing = [db.Key.from_path('PlayerGame', x, parent = game.key())
+                   for x in game.players if x not in cached]
+        if missing:
+            players.extend([x for x in db.get(missing) if x is not None])
+        channel_ids = []
+        for player in players:
+            channel_ids.extend(player.channels)
+        return presence.live(channel_ids)
     
     def get_game_message(self):
         update = self.updates
@@ -456,15 +493,17 @@ class Tournament(object):
     def send_update(self):
         "Sends an update on all channels for this game"
         message = self.get_game_message()
-        for channel_id in self.get_player_channels():
-            channel.send_message(channel_id, message)
+        fanout.send_batch(self.get_player_channels(), message)
     
 class BaseHandler(webapp.RequestHandler):
-    template_values = {}
+    
+    def initialize(self, request, response):
+        webapp.RequestHandler.initialize(self, request, response)
+        self.template_values = {}
     
     def render(self, path):
         self.template_values.update({'logout_url' : users.create_logout_url('/bye')})
-        return self.response.out.write(template.render(path, 
+        return self.response.out.write(templates.render(path, 
                             self.template_values))
 
 class MainPage(BaseHandler):
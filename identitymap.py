@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Request scoped identity map and unit of work.
+#
+#   While a request is being handled, every cached entity loaded is kept in
+#   the unit of work of the request, so loading the same key again returns
+#   the very same instance instead of deserializing another copy. Puts on
+#   cached entities only mark them dirty; when the request is over all the
+#   dirty entities are stored together, with one batched memcache write.
+#
+#   The unit of work is bound to the thread handling the request, and the
+#   middleware below opens and commits one around every request.
+
+import logging
+import threading
+
+_local = threading.local ()
+
+class UnitOfWork (object):
+
+    def __init__ (self):
+        self.entities = {}
+        self.dirty = {}
+
+    def get (self, key):
+        """
+        Returns (found, entity). An entity known not to exist is found as None
+        """
+        key = str (key)
+        if key in self.entities:
+            return True, self.entities[key]
+        return False, None
+
+    def add (self, key, entity):
+        self.entities[str (key)] = entity
+
+    def mark_dirty (self, entity):
+        key = str (entity.key ())
+        self.entities[key] = entity
+        self.dirty[key] = entity
+
+    def forget (self, key):
+        """
+        The entity is deleted: it is not stored on commit, and found as None
+        """
+        key = str (key)
+        self.dirty.pop (key, None)
+        self.entities[key] = None
+
+    def commit (self, store):
+        """
+        Hands all the dirty entities to `store` in one go
+        """
+        if not self.dirty:
+            return 0
+        entities = self.dirty.values ()
+        self.dirty = {}
+        store (entities)
+        return len (entities)
+
+def current ():
+    """
+    The unit of work of the request being handled, None outside a request
+    """
+    return getattr (_local, 'unit', None)
+
+def begin ():
+    _local.unit = UnitOfWork ()
+    return _local.unit
+
+def end ():
+    _local.unit = None
+
+def lookup (key):
+    unit = current ()
+    if unit is None:
+        return False, None
+    return unit.get (key)
+
+def remember (key, entity):
+    unit = current ()
+    if unit is not None:
+        unit.add (key, entity)
+
+def forget (keys):
+    unit = current ()
+    if unit is not None:
+        for key in keys:
+            unit.forget (key)
+
+def defer_put (entity):
+    """
+    Marks the entity dirty in the current unit of work. Returns False when
+    there is none, and the entity has to be stored right away.
+    """
+    unit = current ()
+    if unit is None:
+        return False
+    unit.mark_dirty (entity)
+    return True
+
+def put_multi (entities, store):
+    """
+    Marks the entities dirty in the current unit of work, so that they are
+    stored once with whatever else the request changed. Outside a request,
+    hands them to `store` right away
+    """
+    unit = current ()
+    if unit is None:
+        store (entities)
+        return
+    for entity in entities:
+        unit.mark_dirty (entity)
+
+def middleware (app, store):
+    """
+    Wraps a WSGI application so that every request runs in its own unit of
+    work, whose dirty entities are passed to `store` once the request has
+    been handled
+    """
+    def run_in_unit_of_work (environ, start_response):
+        unit = begin ()
+        try:
+            result = app (environ, start_response)
+            stored = unit.commit (store)
+            logging.info ('Unit of work stored %d entities' % stored)
+            return result
+        finally:
+            end ()
+    return run_in_unit_of_work
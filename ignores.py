@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Ignore lists: a player who ignores another gets none of their chat and
+#   no invitations from them.
+#
+#   Every (player, ignored player) pair is an IgnorePair entity, whose key
+#   name makes the combination unique. What delivery needs is the other
+#   way round, the players who ignore the sender of a message, and that is
+#   kept per player in memcache, built from the datastore on a miss and
+#   changed with compare-and-set when a pair is added or removed. Filtering
+#   the recipients of a message costs one memcache get for the sender,
+#   however many recipients there are.
+#
+#   The datastore query a list is rebuilt with is only eventually
+#   consistent: the players of a rebuilt list are confirmed against the
+#   pairs before they are trusted, and every list expires after CACHE_TTL
+#   seconds, to be read again.
+#
+#   Up to EXACT_LIMIT players the set is kept as it is. Larger ones are kept
+#   as a Bloom filter, which fits in memcache whatever the size of the list;
+#   the few players it matches are checked against the pairs themselves,
+#   with one batch get, so that a false positive never drops a message.
+
+import array
+import hashlib
+import math
+import struct
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+import cas
+import metrics
+
+EXACT_LIMIT = 1000      # players kept as a plain set, a Bloom filter above
+BLOOM_ERROR = 0.01      # false positive rate of the Bloom filters
+QUERY_BATCH = 1000      # pairs read per query when a list is rebuilt
+CACHE_TTL = 60 * 60     # seconds a list is cached
+
+class IgnorePair (db.Model):
+    """
+    Player `user` ignores player `ignored`. Key name is both of them
+    """
+    user = db.StringProperty ()
+    ignored = db.StringProperty ()
+    created = db.DateTimeProperty (auto_now_add=True)
+
+    @staticmethod
+    def key_name_for (user, ignored):
+        return '%s|%s' % (user, ignored)
+
+    @classmethod
+    def key_for (cls, user, ignored):
+        return db.Key.from_path (cls.kind (), cls.key_name_for (user, ignored))
+
+class BloomFilter (object):
+    """
+    A set which can tell for sure that an item is not in it, and is wrong
+    about BLOOM_ERROR of the items it claims are
+    """
+    def __init__ (self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = array.array ('B', '\0' * ((bits + 7) / 8))
+
+    @classmethod
+    def sized (cls, items, error=BLOOM_ERROR):
+        items = max (items, 1)
+        bits = int (math.ceil (-items * math.log (error) / math.log (2) ** 2))
+        hashes = max (1, int (round (bits / float (items) * math.log (2))))
+        return cls (bits, hashes)
+
+    def _positions (self, item):
+        if isinstance (item, unicode):
+            item = item.encode ('utf-8')
+        h1, h2 = struct.unpack ('<QQ', hashlib.md5 (item).digest ())
+        return [(h1 + i * h2) % self.bits for i in xrange (self.hashes)]
+
+    def add (self, item):
+        for position in self._positions (item):
+            self.data[position / 8] |= 1 << (position % 8)
+
+    def __contains__ (self, item):
+        for position in self._positions (item):
+            if not self.data[position / 8] & (1 << (position % 8)):
+                return False
+        return True
+
+    def __getstate__ (self):
+        return (self.bits, self.hashes, self.data.tostring ())
+
+    def __setstate__ (self, state):
+        self.bits, self.hashes, data = state
+        self.data = array.array ('B', data)
+
+class UnconfirmedSet (set):
+    """
+    A set read back from the datastore with a query, which may miss recent
+    changes: its members are confirmed before they are trusted
+    """
+
+def _unsure (users):
+    return isinstance (users, (BloomFilter, UnconfirmedSet))
+
+def _key (user):
+    return 'ignored_by:%s' % user
+
+def _as_filter (users, kind=set):
+    """
+    The set of players, as a Bloom filter when there are too many of them
+    """
+    if len (users) <= EXACT_LIMIT:
+        return kind (users)
+    bloom = BloomFilter.sized (len (users) * 2)
+    for user in users:
+        bloom.add (user)
+    return bloom
+
+def _rebuild (user):
+    """
+    The players who ignore `user`, read from the datastore
+    """
+    query = IgnorePair.all ().filter ('ignored =', user)
+    users = []
+    while True:
+        pairs = query.fetch (QUERY_BATCH)
+        users.extend ([x.user for x in pairs])
+        if len (pairs) < QUERY_BATCH:
+            break
+        query.with_cursor (query.cursor ())
+    metrics.incr ('ignores.rebuilt')
+    return _as_filter (users, UnconfirmedSet)
+
+def ignored_by (users):
+    """
+    The players who ignore each of the users, by user, as a set or a Bloom
+    filter. With one get_multi, the lists memcache does not have are read
+    from the datastore.
+    """
+    users = list (set (users))
+    cached = memcache.get_multi ([_key (x) for x in users])
+    found = {}
+    missing = {}
+    for user in users:
+        value = cached.get (_key (user))
+        if value is None:
+            value = missing[_key (user)] = _rebuild (user)
+        found[user] = value
+    if missing:
+        memcache.add_multi (missing, time=CACHE_TTL)
+    return found
+
+def _confirm (pairs):
+    """
+    The (user, ignored) pairs which really are in the datastore
+    """
+    if not pairs:
+        return set ()
+    metrics.incr ('ignores.confirmed', len (pairs))
+    entities = db.get ([IgnorePair.key_for (user, ignored) for user, ignored in pairs])
+    return set ([(x.user, x.ignored) for x in entities if x is not None])
+
+def ignorers (sender, candidates):
+    """
+    The candidates who ignore the sender
+    """
+    users = ignored_by ([sender])[sender]
+    matched = [x for x in candidates if x in users]
+    if _unsure (users):
+        confirmed = _confirm ([(x, sender) for x in matched])
+        matched = [x for x in matched if (x, sender) in confirmed]
+    return set (matched)
+
+def ignoring (user, senders):
+    """
+    The senders whom the user ignores
+    """
+    senders = list (set (senders))
+    if not senders:
+        return set ()
+    lists = ignored_by (senders)
+    matched = [x for x in senders if user in lists[x]]
+    unsure = [(user, x) for x in matched if _unsure (lists[x])]
+    if unsure:
+        confirmed = _confirm (unsure)
+        matched = [x for x in matched
+                   if not _unsure (lists[x]) or (user, x) in confirmed]
+    return set (matched)
+
+def recipients (sender, channel_ids, owners):
+    """
+    The channels, in order, whose owner does not ignore the sender. `owners`
+    maps channel ids to their owner; channels of unknown owners are kept
+    """
+    dropped = ignorers (sender, set ([x for x in owners.values () if x]))
+    if not dropped:
+        return channel_ids
+    metrics.incr ('ignores.filtered', len (dropped))
+    return [x for x in channel_ids if owners.get (x) not in dropped]
+
+def blocked (user, other):
+    """
+    True when one of the two players ignores the other
+    """
+    lists = ignored_by ([user, other])
+    pairs = []
+    if other in lists[user]:
+        pairs.append ((other, user))
+    if user in lists[other]:
+        pairs.append ((user, other))
+    unsure = [x for x in pairs if _unsure (lists[x[1]])]
+    confirmed = _confirm (unsure)
+    return bool ([x for x in pairs if x not in unsure or x in confirmed])
+
+def _update (user, modify):
+    return cas.update (_key (user), modify, lambda: _rebuild (user),
+                       lambda x: x, lambda x: x, time=CACHE_TTL)
+
+def ignore (user, other):
+    """
+    `user` ignores `other` from now on
+    """
+    IgnorePair (key_name=IgnorePair.key_name_for (user, other),
+                user=user, ignored=other).put ()
+    def add (users):
+        if isinstance (users, set) and len (users) >= EXACT_LIMIT:
+            users = _as_filter (list (users) + [user])
+        users.add (user)
+        return users
+    _update (other, add)
+
+def unignore (user, other):
+    """
+    `user` stops ignoring `other`
+    """
+    db.delete (IgnorePair.key_for (user, other))
+    bloom = []
+    def remove (users):
+        if isinstance (users, BloomFilter):
+            bloom.append (users)
+            return None
+        users.discard (user)
+        return users
+    _update (other, remove)
+    if bloom:
+        #   Nothing can be taken out of a Bloom filter, it is built again
+        memcache.delete (_key (other))
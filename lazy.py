@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Modules imported on first use.
+#
+#   A cold instance has to import everything main2 imports before it can
+#   answer its first request, including modules only a few kinds of request
+#   ever need. Such modules are bound to a LazyModule instead, which imports
+#   the real module the first time one of its attributes is looked up. The
+#   warmup request loads them all before live traffic arrives.
+#
+#   Set EAGER_IMPORTS in the environment to import everything right away,
+#   e.g. to compare start-up times.
+
+import os
+import sys
+
+EAGER = bool (os.environ.get ('EAGER_IMPORTS'))
+
+_modules = []
+
+class LazyModule (object):
+
+    def __init__ (self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load (self):
+        module = self.__dict__['_module']
+        if module is None:
+            name = self.__dict__['_name']
+            __import__ (name)
+            module = self.__dict__['_module'] = sys.modules[name]
+        return module
+
+    def __getattr__ (self, attr):
+        return getattr (self._load (), attr)
+
+    def __repr__ (self):
+        return '<lazy module %s>' % self.__dict__['_name']
+
+def module (name):
+    """
+    The module `name`, imported the first time it is used
+    """
+    lazy_module = LazyModule (name)
+    _modules.append (lazy_module)
+    if EAGER:
+        lazy_module._load ()
+    return lazy_module
+
+def load_all ():
+    """
+    Imports all the modules which are still waiting for their first use
+    """
+    for lazy_module in _modules:
+        lazy_module._load ()
+    return len (_modules)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Offline load tests of main2 and tournament2.
+#
+#   The real WSGI application of main2 is driven with scripted scenarios
+#   (mass join, chat burst, reconnect storm, abusive client, end and join,
+#   cache flush) against the SDK stubs of memcache, the datastore and the
+#   Channel API, with an optional latency injected into every call of a
+#   service to get closer to production.
+#   For every scenario the throughput, the p50/p95/p99 latency of the
+#   requests and the API calls made per request are reported, and written
+#   to a JSON file so that runs can be compared:
+#
+#       python loadtest.py --latency memcache=1 --latency datastore_v3=20 \
+#                          --output after.json --compare before.json
+#
+#   Only the abusive client scenario runs with the rate limits, and checks
+#   that they cap the volume of messages fanned out. The cache flush scenario
+#   flushes memcache in the middle of the load and checks that the loss is
+#   noticed, the lost revisions reported and the cache rebuilt.
+#
+#   The time to first response of a cold instance is measured in child
+#   processes: with every module imported eagerly, with lazy imports, and
+#   with lazy imports and a warmup request before the first user request.
+#
+#   Fan-out batches are run by a local queue right after the request which
+#   dispatched them, outside of its timing, so that they do not pile up.
+#   Like bench.py it needs the App Engine SDK to be importable.
+
+import logging
+import os
+import sys
+import time
+import urllib
+import subprocess
+import optparse
+import StringIO
+
+from google.appengine.api import apiproxy_stub_map
+
+from bench import ROOT, setup_testbed, percentile
+import lazy
+
+#   Not imported up front, it would spoil the cold start measurements
+simplejson = lazy.module ('django.utils.simplejson')
+
+class ServiceHook (object):
+    """
+    Called before every API call: sleeps for the latency injected into the
+    service and counts the call
+    """
+    def __init__ (self, latency=None):
+        self.latency = latency or {}
+        self.calls = {}
+
+    def __call__ (self, service, call, request, response):
+        self.calls[service] = self.calls.get (service, 0) + 1
+        delay = self.latency.get (service)
+        if delay:
+            time.sleep (delay / 1000.0)
+
+    def install (self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks ().Append ('loadtest', self)
+
+    def reset (self):
+        calls, self.calls = self.calls, {}
+        return calls
+
+def call (app, method, path, userid=None, params=None, admin=False):
+    """
+    Runs one request through the WSGI application, as the given user.
+    Returns the status code and the body.
+    """
+    query = ''
+    body = ''
+    if params and method == 'GET':
+        query = urllib.urlencode (params)
+    elif params:
+        body = urllib.urlencode (params)
+    environ = {'REQUEST_METHOD' : method,
+               'PATH_INFO' : path,
+               'QUERY_STRING' : query,
+               'SERVER_NAME' : 'localhost',
+               'SERVER_PORT' : '8080',
+               'SERVER_PROTOCOL' : 'HTTP/1.1',
+               'CONTENT_TYPE' : 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH' : str (len (body)),
+               'wsgi.input' : StringIO.StringIO (body),
+               'wsgi.errors' : sys.stderr,
+               'wsgi.url_scheme' : 'http',
+               'wsgi.version' : (1, 0),
+               'wsgi.multithread' : False,
+               'wsgi.multiprocess' : False,
+               'wsgi.run_once' : False}
+    os.environ['USER_EMAIL'] = userid and '%s@example.com' % userid or ''
+    os.environ['USER_ID'] = userid or ''
+    os.environ['USER_IS_ADMIN'] = admin and '1' or '0'
+    status = []
+    def start_response (code, headers, exc_info=None):
+        status.append (int (code.split ()[0]))
+    output = ''.join (app (environ, start_response))
+    return status[0], output
+
+class Run (object):
+    """
+    The requests of a scenario and what they cost
+    """
+    def __init__ (self, hook, queue):
+        self.hook = hook
+        self.queue = queue
+        self.latencies = []
+        self.errors = 0
+        self.exceptions = 0
+        self.statuses = {}
+        self.calls = {}
+        self.started = time.time ()
+
+    def request (self, app, method, path, userid=None, params=None):
+        self.hook.reset ()
+        start = time.time ()
+        try:
+            code, body = call (app, method, path, userid, params)
+        except Exception:
+            logging.exception ('%s %s as %s failed' % (method, path, userid))
+            self.exceptions += 1
+            code = 500
+        self.latencies.append ((time.time () - start) * 1000.0)
+        self.statuses[code] = self.statuses.get (code, 0) + 1
+        if code >= 400 and code != 429:
+            self.errors += 1
+        for service, count in self.hook.reset ().items ():
+            self.calls[service] = self.calls.get (service, 0) + count
+        self.queue.run ()
+        self.hook.reset ()
+
+    def result (self):
+        elapsed = time.time () - self.started
+        requests = len (self.latencies)
+        return {'requests' : requests,
+                'errors' : self.errors,
+                'exceptions' : self.exceptions,
+                'rejected' : self.statuses.get (429, 0),
+                'seconds' : elapsed,
+                'throughput' : requests / (elapsed or 1),
+                'p50' : percentile (self.latencies, 50),
+                'p95' : percentile (self.latencies, 95),
+                'p99' : percentile (self.latencies, 99),
+                'calls_per_request' : dict ((k, v / float (requests or 1))
+                                            for k, v in self.calls.items ())}
+
+def join (app, run, userid):
+    run.request (app, 'GET', '/', userid)
+    run.request (app, 'POST', '/joingame', userid)
+
+def mass_join (app, hook, queue, users=200):
+    """
+    Many players arriving and joining rooms
+    """
+    run = Run (hook, queue)
+    for i in xrange (users):
+        join (app, run, 'mass-%d' % i)
+    return run.result ()
+
+def chat_burst (app, hook, queue, users=20, messages=500):
+    """
+    The players of a few rooms chatting as fast as they can
+    """
+    setup = Run (hook, queue)
+    for i in xrange (users):
+        join (app, setup, 'burst-%d' % i)
+    run = Run (hook, queue)
+    for i in xrange (messages):
+        run.request (app, 'POST', '/chat', 'burst-%d' % (i % users),
+                     {'m' : 'message %d' % i})
+    return run.result ()
+
+def reconnect_storm (app, hook, queue, users=100, messages=200):
+    """
+    Every player of busy rooms refreshing the page at once, some of them
+    a few updates behind and some too far behind to catch up
+    """
+    setup = Run (hook, queue)
+    for i in xrange (users):
+        join (app, setup, 'storm-%d' % i)
+    for i in xrange (messages):
+        setup.request (app, 'POST', '/chat', 'storm-%d' % (i % users),
+                       {'m' : 'message %d' % i})
+    run = Run (hook, queue)
+    for i in xrange (users):
+        userid = 'storm-%d' % i
+        run.request (app, 'GET', '/', userid)
+        run.request (app, 'POST', '/joingame', userid,
+                     {'seq' : max (messages - (i % 10) * 10, 1)})
+    return run.result ()
+
+def first_response (warmup=False):
+    """
+    Runs in a fresh process: imports main2 and serves the first request.
+    Returns the milliseconds spent in each step
+    """
+    os.chdir (ROOT)
+    tb = setup_testbed ()
+    try:
+        start = time.time ()
+        import main2
+        imported = time.time ()
+        if warmup:
+            call (main2.application, 'GET', '/_ah/warmup', admin=True)
+        warm = time.time ()
+        code, body = call (main2.application, 'GET', '/', 'cold-start')
+        done = time.time ()
+    finally:
+        tb.deactivate ()
+    return {'import' : (imported - start) * 1000.0,
+            'warmup' : (warm - imported) * 1000.0,
+            'first_response' : (done - warm) * 1000.0,
+            'total' : (done - start) * 1000.0,
+            'status' : code}
+
+COLD_STARTS = [('eager', {'EAGER_IMPORTS' : '1'}, []),
+               ('lazy', {}, []),
+               ('lazy_warmup', {}, ['--warmup'])]
+
+def cold_start ():
+    """
+    Time to first response of fresh processes, for every start-up mode
+    """
+    results = {}
+    for name, env, args in COLD_STARTS:
+        environ = dict (os.environ)
+        environ.update (env)
+        child = subprocess.Popen ([sys.executable, os.path.abspath (__file__),
+                                   '--first-response'] + args,
+                                  env=environ, stdout=subprocess.PIPE)
+        output = child.communicate ()[0]
+        results[name] = result = simplejson.loads (output.strip ().splitlines ()[-1])
+        print '%-16s import %8.2f  warmup %8.2f  first response %8.2f  total %8.2f ms' % (
+                name, result['import'], result['warmup'],
+                result['first_response'], result['total'])
+    return results
+
+def abusive_client (app, hook, queue, users=20, messages=300):
+    """
+    One player of a full room sending chat as fast as it can. The rate
+    limits have to cap the messages fanned out to the room
+    """
+    import ratelimit
+    setup = Run (hook, queue)
+    for i in xrange (users):
+        join (app, setup, 'abuse-%d' % i)
+    run = Run (hook, queue)
+    for i in xrange (messages):
+        run.request (app, 'POST', '/chat', 'abuse-0', {'m' : 'spam %d' % i})
+    result = run.result ()
+    rate, burst = ratelimit.LIMITS['chat']
+    epochs = int (result['seconds'] / ratelimit.EPOCH) + 1
+    allowed = burst * epochs + rate * result['seconds']
+    sent = sum ([v for k, v in run.calls.items () if k in ('channel', 'xmpp')])
+    result.update ({'fanned_out' : sent,
+                    'fan_out_cap' : int (allowed * users),
+                    'capped' : sent <= allowed * users})
+    print '%-16s %d of %d messages fanned out, %d sends, cap %d: %s' % (
+            'abusive_client', messages - result['rejected'], messages, sent,
+            result['fan_out_cap'], result['capped'] and 'capped' or 'NOT CAPPED')
+    return result
+
+def run_recovery_tasks ():
+    """
+    Runs the report tasks enqueued by recovery and drops the rebuild ones,
+    whose work rebuild_all does. Returns the number of reports run
+    """
+    import base64
+    import cgi
+    import recovery
+    stub = apiproxy_stub_map.apiproxy.GetStub ('taskqueue')
+    reports = 0
+    for task in stub.GetTasks (recovery.REBUILD_QUEUE):
+        params = cgi.parse_qs (base64.b64decode (task['body']))
+        if 'written' in params:
+            recovery.report_lost_revisions (recovery.decode_written (params['written'][0]))
+            reports += 1
+    stub.FlushQueue (recovery.REBUILD_QUEUE)
+    return reports
+
+def end_and_join (app, hook, queue, users=10):
+    """
+    A room ended and a player leaving a full room, then more players
+    joining. Nobody may be seated in the ended room, every room joined has
+    to be on the round scheduler, and the seat left is given again
+    """
+    from tournament2 import DeathMatch, Player
+    setup = Run (hook, queue)
+    for i in xrange (users):
+        join (app, setup, 'end-%d' % i)
+    ended = str (Player.from_id ('end-0').game_key)
+    DeathMatch.from_id (ended).end ()
+    leaving = Player.from_id ('end-%d' % (users - 1))
+    left = str (leaving.game_key)
+    DeathMatch.from_id (left).expel (leaving)
+    run = Run (hook, queue)
+    for i in xrange (users):
+        join (app, run, 'end-new-%d' % i)
+    rooms = [str (Player.from_id ('end-new-%d' % i).game_key) for i in xrange (users)]
+    result = run.result ()
+    result.update ({'in_ended_room' : len ([x for x in rooms if x == ended]),
+                    'unscheduled' : len ([x for x in set (rooms)
+                                          if DeathMatch.from_id (x).deadline is None]),
+                    'reopened' : left in rooms})
+    print '%-16s %d joins in the ended room, %d rooms unscheduled, seat left %s' % (
+            'end_and_join', result['in_ended_room'], result['unscheduled'],
+            result['reopened'] and 'given again' or 'NOT GIVEN AGAIN')
+    return result
+
+def cache_flush (app, hook, queue, users=20, messages=300):
+    """
+    Memcache flushed halfway through a chat burst. The revisions lost with
+    it have to be reported, and the load measured right after the flush,
+    then again once the cache has been rebuilt in bulk
+    """
+    from google.appengine.api import memcache
+    import recovery
+    setup = Run (hook, queue)
+    for i in xrange (users):
+        join (app, setup, 'flush-%d' % i)
+    def chat (run, first, count):
+        for i in xrange (first, first + count):
+            run.request (app, 'POST', '/chat', 'flush-%d' % (i % users),
+                         {'m' : 'message %d' % i})
+    before = Run (hook, queue)
+    chat (before, 0, messages / 2)
+    losses = recovery.stats['losses']
+    lost = recovery.stats['lost_revisions']
+    memcache.flush_all ()
+    run = Run (hook, queue)
+    #   The first request notices the loss, its reports are run before the
+    #   datastore moves on
+    chat (run, messages / 2, 1)
+    run_recovery_tasks ()
+    chat (run, messages / 2 + 1, messages / 2 - 1)
+    start = time.time ()
+    rebuilt = recovery.rebuild_all ()
+    rebuild_ms = (time.time () - start) * 1000.0
+    after = Run (hook, queue)
+    chat (after, messages, messages / 2)
+    result = run.result ()
+    reads = [x.result ()['calls_per_request'].get ('datastore_v3', 0)
+             for x in (before, run, after)]
+    result.update ({'detected' : recovery.stats['losses'] > losses,
+                    'lost_revisions' : recovery.stats['lost_revisions'] - lost,
+                    'rebuilt' : rebuilt,
+                    'rebuild_ms' : rebuild_ms,
+                    'datastore_calls_per_request' : reads})
+    print '%-16s loss %s, %d revisions lost, %d entities rebuilt in %.1f ms' % (
+            'cache_flush', result['detected'] and 'detected' or 'NOT DETECTED',
+            result['lost_revisions'], rebuilt, rebuild_ms)
+    print '%-16s datastore calls per request: %.2f before, %.2f after the flush, %.2f rebuilt' % (
+            ('',) + tuple (reads))
+    return result
+
+#   name, scenario, whether it runs with the rate limits
+SCENARIOS = [('mass_join', mass_join, False),
+             ('chat_burst', chat_burst, False),
+             ('reconnect_storm', reconnect_storm, False),
+             ('abusive_client', abusive_client, True),
+             ('end_and_join', end_and_join, False),
+             ('cache_flush', cache_flush, False)]
+
+#   Limits high enough never to get in the way of the load scenarios
+UNLIMITED = (10 ** 6, 10 ** 6)
+
+def compare (results, previous):
+    print '%-16s %-12s %12s %12s %9s' % ('scenario', 'metric', 'before', 'after', 'change')
+    for name, result in sorted (results.items ()):
+        old = previous.get (name)
+        if old is None or name == 'cold_start':
+            continue
+        for metric in ('throughput', 'p50', 'p95', 'p99'):
+            change = (result[metric] - old[metric]) / (old[metric] or 1) * 100
+            print '%-16s %-12s %12.2f %12.2f %+8.1f%%' % (name, metric, old[metric],
+                                                        result[metric], change)
+
+def main (argv):
+    parser = optparse.OptionParser (usage='%prog [options] [scenario ...]')
+    parser.add_option ('--latency', action='append', default=[],
+                       help='service=milliseconds injected into every call')
+    parser.add_option ('--output', default='loadtest.json',
+                       help='file the results are written to')
+    parser.add_option ('--compare', help='results of an earlier run')
+    parser.add_option ('--first-response', action='store_true',
+                       help=optparse.SUPPRESS_HELP)
+    parser.add_option ('--warmup', action='store_true',
+                       help=optparse.SUPPRESS_HELP)
+    options, names = parser.parse_args (argv)
+    if options.first_response:
+        print simplejson.dumps (first_response (options.warmup))
+        return
+    latency = {}
+    for item in options.latency:
+        service, ms = item.split ('=')
+        latency[service] = float (ms)
+
+    os.chdir (ROOT)
+    tb = setup_testbed ()
+    hook = ServiceHook (latency)
+    hook.install ()
+    import fanout
+    queue = fanout.LocalQueue ()
+    old_backend = fanout.set_backend (queue)
+    try:
+        import main2
+        results = {}
+        import ratelimit
+        limits = dict (ratelimit.LIMITS)
+        for name, scenario, limited in SCENARIOS:
+            if names and name not in names:
+                continue
+            if limited:
+                ratelimit.LIMITS.update (limits)
+            else:
+                ratelimit.LIMITS.update (dict.fromkeys (limits, UNLIMITED))
+            results[name] = result = scenario (main2.application, hook, queue)
+            print '%-16s %6d requests %8.1f req/s  p50 %7.2f  p95 %7.2f  p99 %7.2f ms  %d errors' % (
+                    name, result['requests'], result['throughput'],
+                    result['p50'], result['p95'], result['p99'], result['errors'])
+            print '%-16s calls per request: %s' % ('', ', '.join (
+                    ['%s %.1f' % x for x in sorted (result['calls_per_request'].items ())]))
+    finally:
+        fanout.set_backend (old_backend)
+        tb.deactivate ()
+    if not names or 'cold_start' in names:
+        results['cold_start'] = cold_start ()
+    output = open (options.output, 'w')
+    try:
+        simplejson.dump ({'time' : time.time (),
+                          'latency' : latency,
+                          'results' : results}, output, indent=2)
+    finally:
+        output.close ()
+    if options.compare:
+        previous = simplejson.load (open (options.compare))
+        compare (results, previous['results'])
+
+
+if __name__ == '__main__':
+    main (sys.argv[1:])
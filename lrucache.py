@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   A bounded in-process cache.
+#
+#   Entries are evicted least recently used first once the cache holds more
+#   than max_items entries or max_bytes bytes, and expire ttl seconds after
+#   they were set. Every entry can carry a version; a get asking for another
+#   version treats the entry as stale and drops it. Hits, misses, evictions,
+#   expirations and stale entries are counted so the limits can be sized
+#   for each instance class.
+
+import time
+
+#   Positions in an entry of the recency list
+PREV, NEXT, KEY, VALUE, VERSION, SIZE, EXPIRES = range (7)
+
+class LRUCache (object):
+
+    def __init__ (self, max_items=1000, max_bytes=8 * 1024 * 1024, ttl=60):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clear ()
+
+    def clear (self):
+        self._entries = {}
+        #   Sentinel of the circular recency list, most recent entry first
+        self._root = root = [None] * 7
+        root[PREV] = root[NEXT] = root
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.expirations = self.invalidations = 0
+
+    def __len__ (self):
+        return len (self._entries)
+
+    def __contains__ (self, key):
+        return key in self._entries
+
+    def keys (self):
+        return self._entries.keys ()
+
+    def _unlink (self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _link_first (self, entry):
+        root = self._root
+        entry[PREV] = root
+        entry[NEXT] = root[NEXT]
+        root[NEXT][PREV] = entry
+        root[NEXT] = entry
+
+    def _remove (self, entry):
+        self._unlink (entry)
+        del self._entries[entry[KEY]]
+        self.bytes -= entry[SIZE]
+
+    def get (self, key, version=None, default=None):
+        """
+        Returns the value cached for key. With a version, only a value set
+        with that same version is returned.
+        """
+        entry = self._entries.get (key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[EXPIRES] < time.time ():
+            self._remove (entry)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        if version is not None and entry[VERSION] != version:
+            self._remove (entry)
+            self.invalidations += 1
+            self.misses += 1
+            return default
+        self._unlink (entry)
+        self._link_first (entry)
+        self.hits += 1
+        return entry[VALUE]
+
+    def set (self, key, value, version=None, size=0, ttl=None):
+        """
+        Caches the value. `size` is the number of bytes the value is
+        accounted for against max_bytes.
+        """
+        if key in self._entries:
+            self._remove (self._entries[key])
+        if size > self.max_bytes:
+            return
+        expires = time.time () + (ttl or self.ttl)
+        entry = [None, None, key, value, version, size, expires]
+        self._link_first (entry)
+        self._entries[key] = entry
+        self.bytes += size
+        root = self._root
+        while len (self._entries) > self.max_items or self.bytes > self.max_bytes:
+            self._remove (root[PREV])
+            self.evictions += 1
+
+    def pop (self, key, default=None):
+        entry = self._entries.get (key)
+        if entry is None:
+            return default
+        self._remove (entry)
+        return entry[VALUE]
+
+    def stats (self):
+        return {'items' : len (self._entries),
+                'bytes' : self.bytes,
+                'max_items' : self.max_items,
+                'max_bytes' : self.max_bytes,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'expirations' : self.expirations,
+                'invalidations' : self.invalidations}
@@ -5,16 +5,19 @@ from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.api import channel
 from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext.webapp import template
 
 from tournament import Game, Player
+import templates
 
 class BaseHandler(webapp.RequestHandler):
-    template_values = {}
+
+    def initialize(self, request, response):
+        webapp.RequestHandler.initialize(self, request, response)
+        self.template_values = {}
 
     def render(self, path):
         self.template_values.update({'logout_url' : users.create_logout_url('/bye')})
-        return self.response.out.write(template.render(path,
+        return self.response.out.write(templates.render(path,
                             self.template_values))
 
 
@@ -7,27 +7,77 @@ import time
 
 from google.appengine.ext import webapp
 from google.appengine.api import users, channel
+from google.appengine.ext import db
 
 from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.ext.webapp import template
 
-from tournament2 import DeathMatch, Player
+from django.utils import simplejson
+
+from tournament2 import DeathMatch, Player, write_behind, store_entities, get2, \
+                        global_cache_stats
+from chat import RecentChat
+
+import codec
+import fanout
+import identitymap
+import ignores
+import lazy
+import matchmaking
+import metrics
+import occupancy
+import powerups
+import presence
+import ratelimit
+import recovery
+import rounds
+import templates
+
+#   Needed by a few kinds of request only, imported on first use
+sweeper = lazy.module ('sweeper')
 
 class BaseHandler (webapp.RequestHandler):
-    template_values = {}
+
+    def initialize (self, request, response):
+        webapp.RequestHandler.initialize (self, request, response)
+        self.template_values = {}
 
     def render (self, path):
         self.template_values.update ({'logout_url' : users.create_logout_url ('/bye')})
-        return self.response.out.write (template.render (path,
+        return self.response.out.write (templates.render (path,
                                     self.template_values))
 
+    def player_keyname (self):
+        """
+        The `player` parameter, the id of a player as sent in the updates.
+        None when it is not the id of a player
+        """
+        try:
+            key = db.Key (self.request.get ('player'))
+        except db.BadKeyError:
+            return None
+        if key.kind () != Player.kind ():
+            return None
+        return str (key)
+
+    def too_many_requests (self):
+        self.response.set_status (429, 'Too Many Requests')
+        self.response.headers['Retry-After'] = '1'
+
+    def unavailable (self):
+        self.response.set_status (503, 'Service Unavailable')
+        self.response.headers['Retry-After'] = '1'
+
 class MainPage (BaseHandler):
     
     def get (self):
         userid = users.get_current_user ().user_id ()
         player = Player.from_id (userid)
         if player.is_playing:
-            self.template_values.update ({'gamekey' : player.game_in })
+            room = str (player.game_key)
+            #   `</` would end the script the scrollback is written in
+            scrollback = simplejson.dumps (RecentChat.lines (room)).replace ('</', '<\\/')
+            self.template_values.update ({'gamekey' : room,
+                                          'scrollback' : scrollback})
         clientid_for_channel = player.create_channel ()
         token = channel.create_channel (clientid_for_channel)
         self.template_values.update ({'token' : token,
@@ -40,28 +90,270 @@ class JoinGame (BaseHandler):
         Process the req from a client/player to join a room
         """
         userid = users.get_current_user ().user_id ()
+        if not ratelimit.allow (('join', userid)):
+            return self.too_many_requests ()
         player = Player.from_id (userid)
-        if not player.is_playing:
-            return DeathMatch.join_latest_or_new (player)
-        return DeathMatch.resume (player)
+        if not player.is_playing or player.game_key is None:
+            try:
+                return DeathMatch.join_latest_or_new (player)
+            except matchmaking.NoSeatError:
+                return self.unavailable ()
+        since = self.request.get ('seq')
+        if since == '':
+            since = None
+        else:
+            try:
+                since = int (since)
+            except ValueError:
+                return self.error (400)
+        return DeathMatch.resume (player, since)
 
 
 class Chat (BaseHandler):
     def post (self):
         userid = users.get_current_user ().user_id ()
+        player = Player.from_id (userid)
+        #   Checked together: a message turned down by either limit takes
+        #   no token from the other
+        checks = [('chat', userid)]
+        if player.game_key is not None:
+            checks.append (('room_chat', str (player.game_key)))
+        if not ratelimit.allow (*checks):
+            return self.too_many_requests ()
         message = self.request.get ('m', '')
         logging.info (message)
-        Player.from_id (userid).chat (message)
+        player.chat (message)
+
+class Powerup (BaseHandler):
+    def post (self):
+        """
+        Uses the powerup `name` in the player's room and returns the
+        player's stats with it as JSON. Conflict when it can not be used
+        in this round
+        """
+        userid = users.get_current_user ().user_id ()
+        if not ratelimit.allow (('powerup', userid)):
+            return self.too_many_requests ()
+        player = Player.from_id (userid)
+        if not player.is_playing or player.game_key is None:
+            return self.error (400)
+        room = DeathMatch.from_id (player.game_key)
+        try:
+            stats = room.use_powerup (player, self.request.get ('name'))
+        except powerups.UnavailableError:
+            return self.error (409)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write (simplejson.dumps (stats))
+
+class Invite (BaseHandler):
+    def post (self):
+        """
+        Invites the player whose id is `player` to a 1-on-1 chat. Forbidden
+        when one of the two ignores the other
+        """
+        userid = users.get_current_user ().user_id ()
+        if not ratelimit.allow (('chat', userid)):
+            return self.too_many_requests ()
+        keyname = self.player_keyname ()
+        if keyname is None:
+            return self.error (400)
+        other = get2 (db.Key (keyname))
+        if not isinstance (other, Player):
+            return self.error (400)
+        if not Player.from_id (userid).invite (other):
+            return self.error (403)
+
+class Ignore (BaseHandler):
+    def post (self):
+        """
+        Ignores the player whose id is `player`, or stops ignoring them
+        when `undo` is set
+        """
+        userid = users.get_current_user ().user_id ()
+        player = Player.from_id (userid)
+        other = self.player_keyname ()
+        if other is None or other == player.keyname:
+            return self.error (400)
+        if self.request.get ('undo'):
+            ignores.unignore (player.keyname, other)
+        else:
+            ignores.ignore (player.keyname, other)
+
+class ChatHistory (BaseHandler):
+    def get (self):
+        """
+        Returns a page of the chat log of the player's room as JSON. Pass
+        the `previous` segment of a page as `segment` to get the page before
+        """
+        userid = users.get_current_user ().user_id ()
+        player = Player.from_id (userid)
+        history = {}
+        if player.game_key is not None:
+            segment = self.request.get ('segment', None)
+            if segment:
+                try:
+                    segment = int (segment)
+                except ValueError:
+                    return self.error (400)
+            history = DeathMatch.from_id (player.game_key).chat_history (segment)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write (simplejson.dumps (history))
+
+class Lobby (BaseHandler):
+    def get (self):
+        """
+        Lists the rooms with the number of players in each
+        """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write (simplejson.dumps ({'rooms' : occupancy.lobby ()}))
+
+class FanoutWorker (webapp.RequestHandler):
+    def post (self):
+        """
+        Sends one batch of a room update. Enqueued by fanout.dispatch
+        """
+        sent = fanout.process_payload (self.request.body)
+        logging.info ('Fanout batch delivered to %d channels' % sent)
+
+class FlushWorker (webapp.RequestHandler):
+    def post (self):
+        """
+        Writes dirty cached entities to the datastore. Enqueued by the
+        write-behind flusher, either for a few keys or for a time bucket
+        """
+        keys = self.request.get_all ('keys')
+        if keys:
+            return write_behind.flush (keys)
+        first = self.request.get ('first')
+        last = self.request.get ('last')
+        write_behind.flush_bucket (int (self.request.get ('bucket')),
+                                   first and int (first) or None,
+                                   last and int (last) or None)
+
+class OccupancyRollup (webapp.RequestHandler):
+    def get (self):
+        """
+        Rolls the room occupancy counters up into the datastore and the
+        lobby. Run by cron
+        """
+        rooms = occupancy.rollup ()
+        logging.info ('Occupancy of %d rooms rolled up' % rooms)
+
+class Warmup (webapp.RequestHandler):
+    def get (self):
+        """
+        Readies a new instance before it gets live traffic: imports what is
+        imported lazily, compiles the page and the codec field tables, and
+        creates the cache generation of a new deployment
+        """
+        start = time.time ()
+        recovery.start ()
+        modules = lazy.load_all ()
+        templates.get ('index.html')
+        from chat import ChatLog
+        for model_class in (DeathMatch, Player, ChatLog):
+            codec.field_table (model_class)
+        logging.info ('Warmed up in %.1f ms, %d modules loaded' % (
+                            (time.time () - start) * 1000.0, modules))
+
+class RoundTicker (webapp.RequestHandler):
+    def post (self):
+        """
+        One tick of the round scheduler: advances the rooms which came due
+        and enqueues the next tick
+        """
+        rounds.enqueue_next ()
+        rounds.tick (DeathMatch.advance_rooms)
+
+    def get (self):
+        """
+        Restarts the chain of ticks, should it have broken. Run by cron
+        """
+        rounds.enqueue_next ()
+
+class SweepWorker (webapp.RequestHandler):
+    def post (self):
+        """
+        Sweeps one batch of abandoned rooms or players. Enqueued by sweeper
+        """
+        sweeper.run (self.request.get ('sweep'), self.request.get ('cursor') or None)
+
+    def get (self):
+        """
+        Starts the sweeps. Run by cron
+        """
+        sweeper.start ()
+
+class RecoverWorker (webapp.RequestHandler):
+    def post (self):
+        """
+        Adds one batch of a model back to memcache after it was lost, or
+        reports the revisions lost of a batch of `written` versions.
+        Enqueued by recovery
+        """
+        written = self.request.get ('written')
+        if written:
+            recovery.report_lost_revisions (recovery.decode_written (written))
+        else:
+            recovery.run (self.request.get ('kind'), self.request.get ('cursor') or None)
+
+class ChannelConnected (webapp.RequestHandler):
+    def post (self):
+        """
+        Channel presence notification, the client is listening
+        """
+        channel_id = self.request.get ('from')
+        owner = presence.connected (channel_id)
+        logging.info ('Channel %s of %s connected' % (channel_id, owner))
+
+class ChannelDisconnected (webapp.RequestHandler):
+    def post (self):
+        """
+        Channel presence notification, the client is gone
+        """
+        channel_id = self.request.get ('from')
+        presence.disconnected ([channel_id])
+        logging.info ('Channel %s disconnected' % channel_id)
+
+class Metrics (webapp.RequestHandler):
+    def get (self):
+        """
+        The hot path counters and latency histograms as JSON: the totals of
+        all the instances, what this instance has not flushed yet, and the
+        hits and misses of this instance's entity cache
+        """
+        if self.request.get ('flush'):
+            metrics.flush (force=True)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write (simplejson.dumps ({'total' : metrics.report (),
+                                                    'local' : metrics.local_report (),
+                                                    'entity_cache' : global_cache_stats ()}))
 
 
-application = webapp.WSGIApplication(
+application = identitymap.middleware (webapp.WSGIApplication(
                             [('/', MainPage),
                             ('/joingame.*', JoinGame),
                             ('/chat', Chat),
+                            ('/chat/history', ChatHistory),
+                            ('/powerup', Powerup),
+                            ('/invite', Invite),
+                            ('/ignore', Ignore),
+                            ('/lobby', Lobby),
+                            ('/tasks/fanout', FanoutWorker),
+                            ('/tasks/flush', FlushWorker),
+                            ('/tasks/occupancy', OccupancyRollup),
+                            ('/tasks/rounds', RoundTicker),
+                            ('/_ah/warmup', Warmup),
+                            ('/tasks/sweep', SweepWorker),
+                            ('/tasks/recover', RecoverWorker),
+                            ('/admin/metrics', Metrics),
+                            ('/_ah/channel/connected/', ChannelConnected),
+                            ('/_ah/channel/disconnected/', ChannelDisconnected),
                             # ('/bye', Bye),
                             # ('/leave', Leave),
                             ],
-                            debug=True)
+                            debug=True), store_entities)
+application = metrics.middleware (application)
 
 def main():
     run_wsgi_app(application)
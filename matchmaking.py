@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Matchmaking: hands out seats in game rooms.
+#
+#   Up to OPEN_ROOMS rooms of a kind are open at a time, listed under one
+#   memcache key which is only ever changed with compare-and-set. Every room
+#   has a seat counter and a join takes a seat with an atomic incr on it, so
+#   concurrent joins can not put more than max_players players in a room.
+#   The room which gives out its last seat, or which turns out to be full,
+#   is taken off the open list. A new room is only opened when no open room
+#   has a seat left and the open list has room for it, so a burst of joins
+#   fills the rooms up instead of creating a crowd of half-empty ones.
+#
+#   A new room is listed as pending while the join which opened it creates
+#   it, and other joins only take seats in it once it is ready, so nobody
+#   joins a room which does not exist yet. A pending room whose creator
+#   never got back is dropped after PENDING_TIMEOUT seconds. A room whose
+#   seat counter memcache has evicted is closed: seats taken but not stored
+#   in the room yet can not be counted again, and a new counter starting
+#   from zero would fill the room past max_players.
+
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+
+import metrics
+
+OPEN_ROOMS = 4          # rooms of a kind joins are spread over
+CAS_RETRIES = 10
+MAX_ATTEMPTS = 5        # rounds of looking for a seat before giving up
+PENDING_TIMEOUT = 30    # seconds a new room may take to be created
+RETRY_WAIT = 0.05       # seconds, times the attempt, before looking again
+
+#   Seat counters outlive the rooms by far, a room never waits that long
+SEATS_TTL = 24 * 60 * 60
+
+class NoSeatError (Exception):
+    pass
+
+class Matchmaker (object):
+
+    def __init__ (self, kind, open_rooms=OPEN_ROOMS):
+        self.kind = kind
+        self.open_rooms = open_rooms
+        self.open_key = 'matchmaking:open:%s' % kind
+
+    def _seats_key (self, room):
+        return 'matchmaking:seats:%s:%s' % (self.kind, room)
+
+    def _new_room_name (self):
+        return '%f.%d' % (time.time (), random.randint (0, 9999))
+
+    def _update_open (self, update):
+        """
+        Applies update to the list of open rooms with compare-and-set.
+        update returns the new list, or None to leave the list alone.
+        Returns True when the list was changed.
+        """
+        client = memcache.Client ()
+        for i in xrange (CAS_RETRIES):
+            rooms = client.gets (self.open_key)
+            if rooms is None:
+                new_rooms = update ([])
+                if new_rooms is None:
+                    return False
+                if client.add (self.open_key, new_rooms):
+                    return True
+            else:
+                new_rooms = update (rooms)
+                if new_rooms is None:
+                    return False
+                if client.cas (self.open_key, new_rooms):
+                    return True
+        logging.warning ('Could not update the open %s rooms' % self.kind)
+        return False
+
+    def _entries (self, rooms):
+        """
+        The (room, pending since) entries of the open list, pending since
+        being None for the rooms which are ready, without the pending rooms
+        given up on
+        """
+        entries = []
+        now = time.time ()
+        for entry in rooms:
+            if isinstance (entry, basestring):
+                entry = (entry, None)
+            if entry[1] is None or now - entry[1] < PENDING_TIMEOUT:
+                entries.append (tuple (entry))
+        return entries
+
+    def open_rooms_list (self):
+        """
+        The open rooms which are ready for players
+        """
+        return [room for room, pending in self._entries (memcache.get (self.open_key) or [])
+                if pending is None]
+
+    def close (self, room):
+        """
+        Takes the room off the open list
+        """
+        def remove (rooms):
+            entries = self._entries (rooms)
+            if room not in [x for x, pending in entries]:
+                return None
+            return [x for x in entries if x[0] != room]
+        return self._update_open (remove)
+
+    def _open (self, room, pending=None):
+        def add (rooms):
+            entries = self._entries (rooms)
+            if room in [x for x, p in entries] or len (entries) >= self.open_rooms:
+                return None
+            return entries + [(room, pending)]
+        return self._update_open (add)
+
+    def _ready (self, room):
+        def ready (rooms):
+            entries = self._entries (rooms)
+            if (room, None) in entries:
+                return None
+            return [x for x in entries if x[0] != room] + [(room, None)]
+        return self._update_open (ready)
+
+    def reserve (self, max_players, create=None):
+        """
+        Takes a seat for a player. Returns (room, seat, is_new): the key name
+        of the room, the number of the seat and whether the room is a new one.
+        A new room is made by create (room) before other joins are let in.
+        """
+        for attempt in xrange (MAX_ATTEMPTS):
+            rooms = self.open_rooms_list ()
+            random.shuffle (rooms)
+            for room in rooms:
+                #   No initial value: a counter which is gone stays gone
+                seat = memcache.incr (self._seats_key (room))
+                if seat is None:
+                    metrics.incr ('matchmaking.seats_lost')
+                    self.close (room)
+                    continue
+                if max_players == -1 or seat <= max_players:
+                    if seat == max_players:
+                        self.close (room)
+                    return room, seat, False
+                #   Full already, give back the seat counted too many
+                memcache.decr (self._seats_key (room))
+                self.close (room)
+            room = self._new_room_name ()
+            memcache.set (self._seats_key (room), 1, time=SEATS_TTL)
+            if max_players == 1 or self._open (room, pending=time.time ()):
+                try:
+                    if create is not None:
+                        create (room)
+                except:
+                    self.close (room)
+                    raise
+                if max_players != 1:
+                    self._ready (room)
+                return room, 1, True
+            #   Another join opened a room in the mean time, try its seats
+            #   once it is ready
+            memcache.delete (self._seats_key (room))
+            time.sleep (RETRY_WAIT * (attempt + 1))
+        raise NoSeatError ('No seat found in a %s room' % self.kind)
+
+    def release (self, room, max_players):
+        """
+        Gives back a seat of the room, opening the room again if it was full
+        """
+        seats = memcache.decr (self._seats_key (room))
+        if seats is not None and seats < max_players:
+            self._open (room)
+        return seats
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Counters and latency histograms of the hot paths.
+#
+#   Recording only touches dictionaries in process memory. Every
+#   FLUSH_INTERVAL seconds, at the end of a request, what an instance has
+#   recorded since its last flush is added to the shared totals in memcache
+#   with one offset_multi, so that the totals combine all the instances.
+#   Histograms have fixed buckets (BUCKETS, in milliseconds) and are kept as
+#   one counter per bucket, so they add up across instances the same way.
+#
+#   The names in use are listed under NAMES_KEY, so the totals can be read
+#   back in one get_multi by report().
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+FLUSH_INTERVAL = 30     # seconds between two flushes of an instance
+
+#   Upper bounds of the histogram buckets, in milliseconds. The last bucket
+#   takes everything slower.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+NAMES_KEY = 'metrics:names'
+CAS_RETRIES = 5
+
+_counters = {}
+_last_flush = [time.time ()]
+_names = set ()
+
+def _bucket (ms):
+    for i, bound in enumerate (BUCKETS):
+        if ms <= bound:
+            return i
+    return len (BUCKETS)
+
+def _counter_key (name):
+    return 'metrics:c:%s' % name
+
+def _bucket_key (name, bucket):
+    return 'metrics:h:%s:%d' % (name, bucket)
+
+def _time_key (name):
+    return 'metrics:t:%s' % name
+
+def incr (name, delta=1):
+    """
+    Adds delta to the counter `name`
+    """
+    if delta:
+        key = _counter_key (name)
+        _counters[key] = _counters.get (key, 0) + delta
+        _names.add (('c', name))
+
+def record (name, ms):
+    """
+    Records that the operation `name` took ms milliseconds
+    """
+    key = _bucket_key (name, _bucket (ms))
+    _counters[key] = _counters.get (key, 0) + 1
+    #   total time in microseconds, memcache counters are integers
+    key = _time_key (name)
+    _counters[key] = _counters.get (key, 0) + int (ms * 1000)
+    _names.add (('h', name))
+
+def timed (name):
+    """
+    Decorator recording the latency of every call to the function as `name`
+    """
+    def decorator (fn):
+        def wrapper (*args, **kwargs):
+            start = time.time ()
+            try:
+                return fn (*args, **kwargs)
+            finally:
+                record (name, (time.time () - start) * 1000.0)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+def _register_names ():
+    client = memcache.Client ()
+    for i in xrange (CAS_RETRIES):
+        names = client.gets (NAMES_KEY)
+        if names is None:
+            if client.add (NAMES_KEY, sorted (_names)):
+                return
+            continue
+        if _names.issubset (names):
+            return
+        if client.cas (NAMES_KEY, sorted (_names.union (names))):
+            return
+    logging.warning ('Could not register the metric names')
+
+def flush (force=False):
+    """
+    Adds the counters recorded since the last flush to the totals in
+    memcache, when FLUSH_INTERVAL has passed or with force. Returns the
+    number of counters flushed.
+    """
+    now = time.time ()
+    if not _counters or (not force and now - _last_flush[0] < FLUSH_INTERVAL):
+        return 0
+    _last_flush[0] = now
+    counters = dict (_counters)
+    _counters.clear ()
+    memcache.offset_multi (counters, initial_value=0)
+    _register_names ()
+    return len (counters)
+
+def _summary (counts, total_us):
+    """
+    Count, mean and estimated percentiles of a histogram. A percentile is
+    the upper bound of the bucket it falls in.
+    """
+    count = sum (counts)
+    summary = {'count' : count,
+               'mean_ms' : count and total_us / 1000.0 / count or 0,
+               'buckets' : dict ((i < len (BUCKETS) and str (BUCKETS[i]) or 'inf', n)
+                                 for i, n in enumerate (counts) if n)}
+    for p in (50, 95, 99):
+        rank = count * p / 100.0
+        seen = 0
+        for i, n in enumerate (counts):
+            seen += n
+            if n and seen >= rank:
+                summary['p%d_ms' % p] = i < len (BUCKETS) and BUCKETS[i] or None
+                break
+    return summary
+
+def _report (values, names):
+    counters = {}
+    histograms = {}
+    for kind, name in names:
+        if kind == 'c':
+            counters[name] = int (values.get (_counter_key (name), 0))
+        else:
+            counts = [int (values.get (_bucket_key (name, i), 0))
+                      for i in xrange (len (BUCKETS) + 1)]
+            histograms[name] = _summary (counts, int (values.get (_time_key (name), 0)))
+    return {'counters' : counters, 'histograms' : histograms}
+
+def local_report ():
+    """
+    What this instance has recorded and not flushed yet
+    """
+    return _report (_counters, _names)
+
+def report ():
+    """
+    The totals of all the instances, as flushed to memcache
+    """
+    names = memcache.get (NAMES_KEY) or []
+    keys = []
+    for kind, name in names:
+        if kind == 'c':
+            keys.append (_counter_key (name))
+        else:
+            keys.extend ([_bucket_key (name, i) for i in xrange (len (BUCKETS) + 1)])
+            keys.append (_time_key (name))
+    return _report (memcache.get_multi (keys), names)
+
+def middleware (app):
+    """
+    Wraps a WSGI application to record the latency of every request and
+    flush the metrics of the instance once in a while
+    """
+    def run_recorded (environ, start_response):
+        start = time.time ()
+        try:
+            return app (environ, start_response)
+        finally:
+            record ('request', (time.time () - start) * 1000.0)
+            try:
+                flush ()
+            except Exception, e:
+                logging.warning ('Could not flush the metrics: %s' % e)
+    return run_recorded
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Room occupancy counters and the lobby listing built on them.
+#
+#   Players joining and leaving a room change one of NUM_SHARDS memcache
+#   counters of that room, picked at random, so a busy room is not a single
+#   hot key. The room is also marked dirty. A cron job regularly rolls the
+#   counters of the dirty rooms up into RoomOccupancy entities and patches
+#   the lobby snapshot in memcache with the new counts. Clients polling the
+#   lobby only ever read that snapshot and never touch the room entities.
+
+import random
+
+from google.appengine.api import memcache
+
+from google.appengine.ext import db
+
+from writebehind import DirtySet
+
+NUM_SHARDS = 10
+
+#   memcache counters can not go below zero. They start at OFFSET and the
+#   change in occupancy is their distance to it.
+OFFSET = 2 ** 30
+
+ROLLUP_INTERVAL = 30    # seconds a bucket of dirty rooms collects changes
+MAX_BUCKETS = 20        # buckets looked at when the last rollup is unknown
+
+LOBBY_KEY = 'lobby'
+LOBBY_SIZE = 100        # rooms listed in the lobby
+ROLLED_KEY = 'occupancy:rolled'
+
+class RoomOccupancy (db.Model):
+    """
+    Number of players in a room as of the last rollup, key_name is the room
+    """
+    count = db.IntegerProperty (default=0)
+    updated = db.DateTimeProperty (auto_now=True)
+
+_dirty = DirtySet ('occupancy', ROLLUP_INTERVAL)
+
+def _shard_key (room, shard):
+    return 'occupancy:%s:%d' % (room, shard)
+
+def change (room, delta):
+    """
+    Adds delta, which may be negative, to the number of players in the room
+    """
+    key = _shard_key (room, random.randint (0, NUM_SHARDS - 1))
+    if delta > 0:
+        memcache.incr (key, delta, initial_value=OFFSET)
+    elif delta < 0:
+        memcache.decr (key, -delta, initial_value=OFFSET)
+    _dirty.add (room)
+
+def rollup ():
+    """
+    Moves the counted changes of the rooms marked dirty since the last
+    rollup into the datastore and the lobby snapshot. Returns the number of
+    rooms updated.
+    """
+    current = _dirty.bucket ()
+    last = memcache.get (ROLLED_KEY) or current - MAX_BUCKETS
+    rooms = set ()
+    for bucket in xrange (last + 1, current):
+        rooms.update ([room for room, marked_at in _dirty.slots (bucket)])
+    memcache.set (ROLLED_KEY, current - 1)
+    if not rooms:
+        return 0
+    rooms = list (rooms)
+    shard_keys = [_shard_key (room, x) for room in rooms for x in xrange (NUM_SHARDS)]
+    counted = memcache.get_multi (shard_keys)
+    #   Take what was read off the counters, keeping whatever was counted
+    #   in the mean time
+    offsets = dict ((k, OFFSET - int (v)) for k, v in counted.items ()
+                    if int (v) != OFFSET)
+    if offsets:
+        memcache.offset_multi (offsets)
+    deltas = dict.fromkeys (rooms, 0)
+    for room in rooms:
+        for x in xrange (NUM_SHARDS):
+            value = counted.get (_shard_key (room, x))
+            if value is not None:
+                deltas[room] += int (value) - OFFSET
+    keys = [db.Key.from_path (RoomOccupancy.kind (), room) for room in rooms]
+    entities = []
+    for room, entity in zip (rooms, db.get (keys)):
+        if entity is None:
+            entity = RoomOccupancy (key_name=room)
+        entity.count = max (entity.count + deltas[room], 0)
+        entities.append (entity)
+    db.put (entities)
+    update_lobby (entities)
+    return len (entities)
+
+def _build_lobby ():
+    query = RoomOccupancy.all ().filter ('count >', 0).order ('-count')
+    return dict ((x.key ().name (), x.count) for x in query.fetch (LOBBY_SIZE))
+
+def update_lobby (entities):
+    """
+    Patches the lobby snapshot with the counts of the given rooms
+    """
+    rooms = memcache.get (LOBBY_KEY)
+    if rooms is None:
+        rooms = _build_lobby ()
+    for entity in entities:
+        if entity.count > 0:
+            rooms[entity.key ().name ()] = entity.count
+        else:
+            rooms.pop (entity.key ().name (), None)
+    if len (rooms) > LOBBY_SIZE:
+        rooms = dict (sorted (rooms.items (), key=lambda x: -x[1])[:LOBBY_SIZE])
+    memcache.set (LOBBY_KEY, rooms)
+
+def lobby ():
+    """
+    The rooms and the number of players in each, fullest first
+    """
+    rooms = memcache.get (LOBBY_KEY)
+    if rooms is None:
+        rooms = _build_lobby ()
+        memcache.set (LOBBY_KEY, rooms)
+    return [{'room' : room, 'players' : count}
+            for room, count in sorted (rooms.items (), key=lambda x: -x[1])]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Powerup engine.
+#
+#   The powerup definitions are compiled once into lookup tables: for every
+#   powerup, the state it is in so many rounds after it was used (ACTIVE,
+#   REFILLING or READY again), up to the point where nothing changes any
+#   more. Whether a powerup can be used, and what it adds to a player's
+#   health, attack or defense, is then a lookup in the tables of the
+#   powerups the player used, and never a scan of the definitions.
+#
+#   The tables are cached per process. Changing a definition bumps a
+#   version number in memcache, which processes check every CHECK_INTERVAL
+#   seconds before compiling the definitions again.
+#
+#   What a player did with the powerups is kept as a usage dictionary:
+#   name -> (round last used, times used).
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+DISABLED = 'disabled'   # not enabled yet in this round
+READY = 'ready'
+ACTIVE = 'active'
+REFILLING = 'refilling'
+SPENT = 'spent'         # used up, or not refilling
+
+STATS = ('health', 'attack', 'defense')
+
+VERSION_KEY = 'powerups:version'
+CHECK_INTERVAL = 10     # seconds between two checks of the version
+
+class UnavailableError (Exception):
+    pass
+
+class CompiledPowerup (object):
+    """
+    The lookup table of one powerup definition
+    """
+    def __init__ (self, definition):
+        self.name = definition.name
+        self.acts_on = definition.acts_on
+        self.factor = definition.power_factor or 0
+        self.enabled_after = definition.enabled_after or 0
+        if definition.multiple_usage:
+            self.max_usage = definition.max_usage
+        else:
+            self.max_usage = 1
+        active_time = max (definition.active_time or 0, 0)
+        if definition.refill:
+            ready_after = max (definition.refills_in or 0, active_time)
+            self.settled = READY
+        else:
+            ready_after = active_time
+            self.settled = SPENT
+        #   states[d] is the state d rounds after the powerup was used
+        self.states = tuple ([ACTIVE] * active_time +
+                             [REFILLING] * (ready_after - active_time))
+
+    def state (self, game_round, used=None):
+        """
+        State of the powerup in the round, for a player who used it as
+        `used`, a (round, times) pair, or never
+        """
+        if game_round < self.enabled_after:
+            return DISABLED
+        if used is None:
+            return READY
+        last_round, times = used
+        since = game_round - last_round
+        if since < len (self.states):
+            return self.states[since]
+        if self.max_usage != -1 and times >= self.max_usage:
+            return SPENT
+        return self.settled
+
+class PowerupTable (object):
+    """
+    The compiled tables of all the powerups, by name
+    """
+    def __init__ (self, definitions):
+        self.powerups = dict ((x.name, CompiledPowerup (x)) for x in definitions)
+
+    def state (self, name, game_round, usage):
+        return self.powerups[name].state (game_round, usage.get (name))
+
+    def use (self, name, game_round, usage):
+        """
+        Uses the powerup in the round. Returns the new usage, or raises
+        UnavailableError when the powerup is not ready.
+        """
+        powerup = self.powerups.get (name)
+        if powerup is None:
+            raise UnavailableError ('No powerup %s' % name)
+        used = usage.get (name)
+        state = powerup.state (game_round, used)
+        if state != READY:
+            raise UnavailableError ('Powerup %s is %s' % (name, state))
+        usage = dict (usage)
+        usage[name] = (game_round, (used and used[1] or 0) + 1)
+        return usage
+
+    def bonus (self, stat, game_round, usage):
+        """
+        The bonus, in percent, the active powerups of the player give to
+        the stat in the round
+        """
+        bonus = 0
+        for name, used in usage.items ():
+            powerup = self.powerups.get (name)
+            if (powerup is not None and powerup.acts_on == stat
+                    and powerup.state (game_round, used) == ACTIVE):
+                bonus += powerup.factor
+        return bonus
+
+    def apply (self, stat, value, game_round, usage):
+        """
+        The value of the stat with the bonus of the active powerups
+        """
+        return value + value * self.bonus (stat, game_round, usage) / 100
+
+class Engine (object):
+    """
+    Compiles the definitions returned by `load` and keeps the tables until
+    the definitions change
+    """
+    def __init__ (self, load):
+        self.load = load
+        self._table = None
+        self._version = None
+        self._checked = 0
+
+    def invalidate (self):
+        """
+        Tells every process to compile the definitions again
+        """
+        memcache.incr (VERSION_KEY, initial_value=0)
+        self._table = None
+
+    def table (self):
+        now = time.time ()
+        if self._table is not None and now - self._checked < CHECK_INTERVAL:
+            return self._table
+        self._checked = now
+        version = memcache.get (VERSION_KEY)
+        if self._table is None or version != self._version:
+            self._table = PowerupTable (self.load ())
+            self._version = version
+            logging.info ('Compiled %d powerups' % len (self._table.powerups))
+        return self._table
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Registry of the Channel API channels which are alive.
+#
+#   A channel is registered, with its owner, when it is created, marked
+#   connected and disconnected by the channel presence notifications, and
+#   refreshed whenever it is seen connected. Every entry expires after
+#   CHANNEL_TTL seconds without news, the lifetime of a channel token, so
+#   channels which are never heard of again drop out by themselves. Rooms
+#   fan out only to the channels still in the registry and forget the rest.
+#
+#   A channel which disconnects, or which a send fails on, is marked
+#   DISCONNECTED for the rest of its lifetime.
+#
+#   When memcache is flushed the whole registry is gone at once, and every
+#   channel would look dead. The time the registry was started is kept under
+#   STARTED_KEY: a channel missing from the registry is only known to be dead
+#   once the registry is older than CHANNEL_TTL, until then it may well have
+#   been created before the registry started and is kept.
+
+import time
+
+from google.appengine.api import memcache
+
+CHANNEL_TTL = 2 * 60 * 60   # seconds, the lifetime of a channel token
+
+STARTED_KEY = 'presence:started'
+
+PENDING = 'pending'
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+
+def _key (channel_id):
+    return 'presence:%s' % channel_id
+
+def _set_state (channel_ids, state, owner=None):
+    now = time.time ()
+    memcache.set_multi (dict ((_key (x), (owner, state, now)) for x in channel_ids),
+                        time=CHANNEL_TTL)
+
+def register (channel_id, owner):
+    """
+    Records a new channel of owner, not connected yet
+    """
+    memcache.add (STARTED_KEY, time.time ())
+    _set_state ([channel_id], PENDING, owner)
+
+def connected (channel_id):
+    """
+    Marks the channel connected, and alive for another CHANNEL_TTL
+    """
+    entry = memcache.get (_key (channel_id))
+    owner = entry and entry[0] or None
+    _set_state ([channel_id], CONNECTED, owner)
+    return owner
+
+def disconnected (channel_ids):
+    """
+    Marks the channels dead, nothing is sent on them any more
+    """
+    if channel_ids:
+        _set_state (channel_ids, DISCONNECTED)
+
+def entries (channel_ids):
+    """
+    The (owner, state, last seen) of the registered channels, by channel id
+    """
+    found = memcache.get_multi ([_key (x) for x in channel_ids])
+    return dict ((x, found[_key (x)]) for x in channel_ids if _key (x) in found)
+
+def live (channel_ids):
+    """
+    The channels, in order, which may still be alive. With one get_multi.
+    """
+    return live_owners (channel_ids)[0]
+
+def live_owners (channel_ids):
+    """
+    The channels, in order, which may still be alive, and the owners of the
+    registered ones, by channel id. With one get_multi.
+    """
+    if not channel_ids:
+        return [], {}
+    keys = [_key (x) for x in channel_ids]
+    found = memcache.get_multi (keys + [STARTED_KEY])
+    started = found.get (STARTED_KEY)
+    if started is None:
+        memcache.add (STARTED_KEY, time.time ())
+    trusted = started is not None and time.time () - started > CHANNEL_TTL
+    alive = []
+    owners = {}
+    for channel_id, key in zip (channel_ids, keys):
+        entry = found.get (key)
+        if entry is None:
+            if not trusted:
+                alive.append (channel_id)
+        elif entry[1] != DISCONNECTED:
+            alive.append (channel_id)
+            if entry[0] is not None:
+                owners[channel_id] = entry[0]
+    return alive, owners
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Token bucket rate limits, kept in memcache.
+#
+#   A bucket holds up to `burst` tokens and gains `rate` tokens a second;
+#   every request takes one and is turned down when the bucket is empty.
+#   Only the tokens taken are stored, as a memcache counter bumped with an
+#   atomic incr, and the tokens gained are worked out from the time: the
+#   counter is started afresh every EPOCH seconds, so a bucket holds
+#   burst + rate * (seconds into the epoch) tokens in all. Each check costs
+#   one memcache call, however many buckets it takes tokens from, two when
+#   it turns the request down, and never touches the datastore.
+#
+#   Starting every epoch with a full bucket lets through at most one extra
+#   burst per EPOCH seconds. When memcache does not answer, requests are let
+#   through.
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+EPOCH = 10      # seconds
+
+#   name -> (tokens a second, burst)
+LIMITS = {
+    'chat' : (1, 5),            # chat messages of a player
+    'room_chat' : (5, 20),      # chat messages of all the players of a room
+    'join' : (0.2, 3),          # joins and resumes of a player
+    'powerup' : (1, 3),         # powerups used by a player
+}
+
+def _key (name, subject, epoch):
+    return 'ratelimit:%s:%s:%d' % (name, subject, epoch)
+
+def allow (*checks):
+    """
+    Takes a token from the bucket of every (limit name, subject) pair.
+    Returns False when one of them is empty.
+    """
+    now = time.time ()
+    epoch = int (now / EPOCH)
+    elapsed = now - epoch * EPOCH
+    keys = dict ((_key (name, subject, epoch), name) for name, subject in checks)
+    taken = memcache.offset_multi (dict.fromkeys (keys, 1), initial_value=0)
+    for key, name in keys.items ():
+        count = taken.get (key)
+        if count is None:
+            continue
+        rate, burst = LIMITS[name]
+        if count > burst + rate * elapsed:
+            logging.info ('Rate limit %s hit by %s' % (name, key))
+            #   A request turned down takes no tokens, so that a client
+            #   which slows down is let through again
+            memcache.offset_multi (dict.fromkeys (keys, -1))
+            return False
+    return True
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Detection of memcache losses and bulk rebuild of the cache.
+#
+#   Memcache holds a generation number under GENERATION_KEY, which the
+#   bulk loads read along with the entities, so checking it costs no call
+#   of its own. Warmup creates it, so that a new deployment starts with one.
+#   A flush takes the generation away with the cached entities: a process
+#   which finds it missing, and none of the entities read with it, starts a
+#   new generation. Every process which knew the old one then notices the
+#   change and enqueues the tasks which rebuild the cache from the
+#   datastore, model after model, in batches walked with query cursors.
+#   The tasks are named after the generation, so that they run once.
+#   Entries are added, never set, so that nothing written since the loss is
+#   overwritten. When the entities read along are there, the generation was
+#   evicted alone: it is added back as it was by a process which knew it,
+#   and nothing is rebuilt.
+#
+#   Revisions which were only in memcache are gone with it. Every process
+#   remembers the versions it wrote last, and when it notices a loss it
+#   hands them to report tasks, which compare them with the datastore in
+#   batched gets and report how many revisions were lost.
+
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from codec import serialize_entities
+from lrucache import LRUCache
+import lazy
+import metrics
+
+taskqueue = lazy.module ('google.appengine.api.taskqueue')
+
+GENERATION_KEY = 'cache:generation'
+
+REBUILD_URL = '/tasks/recover'
+REBUILD_QUEUE = 'recovery'
+BATCH = 200                 # entities per datastore query
+
+#   Versions written by this process, checked against the datastore when
+#   the cache is lost
+RECENT_WRITES = 1000       # at most one datastore batch get
+_written = LRUCache (RECENT_WRITES, RECENT_WRITES * 256, 60 * 60)
+
+_known = [None]     # generation this process has seen last
+
+#   Losses noticed by this process
+stats = {'losses' : 0, 'lost_revisions' : 0, 'lost_entities' : 0}
+
+_models = {}
+
+def register (model_class):
+    """
+    Adds a model class to the ones rebuilt after a loss
+    """
+    _models[model_class.kind ()] = model_class
+
+def record_writes (entities):
+    """
+    Remembers the cache versions of the entities just stored
+    """
+    for entity in entities:
+        _written.set (entity.keyname, entity._cache_version, size=256)
+
+def _new_generation ():
+    return '%d.%d' % (time.time (), random.randint (0, 9999))
+
+def start ():
+    """
+    Creates the generation of a new deployment, unless there is one.
+    Called at warmup
+    """
+    return memcache.add (GENERATION_KEY, _new_generation ())
+
+def _restore (found):
+    """
+    Adds the generation back after it went missing. Entries found along with
+    it mean that it was evicted alone and the cache is still the one of the
+    generation known, otherwise a new generation starts. A process which
+    knows no generation leaves it to the ones which do, and returns None
+    """
+    if found and _known[0] is None:
+        return None
+    generation = found and _known[0] or _new_generation ()
+    if memcache.add (GENERATION_KEY, generation):
+        return generation
+    return memcache.get (GENERATION_KEY) or generation
+
+def check (generation, found=0):
+    """
+    Called with the generation read from memcache, None when there was
+    none, and the number of entries found along with it, not counting the
+    markers of missing entities. Returns True when the cache was lost since
+    the last check.
+    """
+    if generation is not None and generation == _known[0]:
+        return False
+    if generation is None:
+        generation = _restore (found)
+    lost = _known[0] is not None and generation is not None and generation != _known[0]
+    _known[0] = generation
+    if lost:
+        logging.warning ('Memcache was lost, now at generation %s' % generation)
+        metrics.incr ('recovery.cache_lost')
+        stats['losses'] += 1
+        _enqueue_rebuild (generation)
+        _enqueue_reports ()
+    return lost
+
+def encode_written (written):
+    return ' '.join (['%s:%d' % (key, version) for key, version in written])
+
+def decode_written (data):
+    written = []
+    for item in data.split ():
+        key, version = item.rsplit (':', 1)
+        written.append ((key, int (version)))
+    return written
+
+def _enqueue_reports ():
+    """
+    Hands the versions this process wrote to report tasks, BATCH at a time
+    """
+    written = [(key, _written.get (key)) for key in _written.keys ()]
+    written = [(key, version) for key, version in written if version is not None]
+    _written.clear ()
+    for i in xrange (0, len (written), BATCH):
+        taskqueue.add (url=REBUILD_URL, queue_name=REBUILD_QUEUE,
+                       params={'written' : encode_written (written[i:i + BATCH])})
+
+def report_lost_revisions (written):
+    """
+    Compares the (key, version) pairs written by a process with the
+    datastore. Returns the number of revisions which were lost with memcache
+    """
+    if not written:
+        return 0
+    stored = db.get ([db.Key (key) for key, version in written])
+    lost = 0
+    entities = 0
+    for (key, version), entity in zip (written, stored):
+        db_version = entity is not None and entity._db_version or 0
+        if version > db_version:
+            lost += version - db_version
+            entities += 1
+    stats['lost_revisions'] += lost
+    stats['lost_entities'] += entities
+    metrics.incr ('recovery.lost_revisions', lost)
+    logging.warning ('%d revisions of %d entities were lost with memcache' % (lost, entities))
+    return lost
+
+def _enqueue (kind, cursor=None, task_name=None):
+    params = {'kind' : kind}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add (url=REBUILD_URL, queue_name=REBUILD_QUEUE, params=params,
+                       name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def _enqueue_rebuild (generation):
+    for kind in _models:
+        _enqueue (kind, task_name='recover-%s-%s' % (kind, generation.replace ('.', '-')))
+
+def rebuild (kind, cursor=None):
+    """
+    Adds one batch of entities of the kind back to memcache. Returns the
+    number of entities read and the cursor of the next batch, None after
+    the last one
+    """
+    query = _models[kind].all ()
+    if cursor:
+        query.with_cursor (cursor)
+    entities = query.fetch (BATCH)
+    if entities:
+        memcache.add_multi (dict ((str (x.key ()), serialize_entities (x)) for x in entities))
+        metrics.incr ('recovery.rebuilt', len (entities))
+    if len (entities) < BATCH:
+        return len (entities), None
+    return len (entities), query.cursor ()
+
+def rebuild_all ():
+    """
+    Rebuilds every model at once, without tasks. Returns the number of
+    entities read
+    """
+    total = 0
+    for kind in _models:
+        cursor = None
+        while True:
+            count, cursor = rebuild (kind, cursor)
+            total += count
+            if cursor is None:
+                break
+    return total
+
+def run (kind, cursor=None):
+    """
+    Rebuilds one batch and enqueues the next one. Returns the number of
+    entities read
+    """
+    count, cursor = rebuild (kind, cursor)
+    if cursor is not None:
+        _enqueue (kind, cursor)
+    logging.info ('Rebuilt %d %s entities in memcache' % (count, kind))
+    return count
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Round scheduler: a timer wheel for the deadlines of all the rooms.
+#
+#   Time is cut in ticks of TICK seconds and every tick is a slot of the
+#   wheel, a DirtySet bucket in memcache listing the rooms due in it. Setting
+#   a deadline adds the room to the slot of its tick, nothing else: there is
+#   no timer nor task per room. A single chain of tick tasks walks the wheel,
+#   every task handles the slots which came due since the previous one and
+#   enqueues the next, one TICK later. The rooms of a slot are advanced
+#   together by the `advance` callback, which loads and stores them in bulk.
+#
+#   The slot of a deadline which is due already is the next tick's, the
+#   task of the tick under way may have run before the room was put in it.
+#   A room whose deadline moved after it was put in a slot is still listed
+#   there; `advance` has to check the deadline of the room itself and skip
+#   it. The cron job restarts the chain should it ever break: tick tasks are
+#   named after their tick, so a chain is never doubled.
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import memcache
+
+import lazy
+from writebehind import DirtySet
+
+taskqueue = lazy.module ('google.appengine.api.taskqueue')
+
+TICK = 5                    # seconds between two ticks
+TICK_URL = '/tasks/rounds'
+TICK_QUEUE = 'rounds'
+
+#   Deadlines can be this far ahead, and a stalled chain catches up this
+#   far back
+HORIZON = 60 * 60
+
+LAST_TICK_KEY = 'rounds:last'
+
+wheel = DirtySet ('rounds', TICK, ttl=HORIZON)
+
+def tick_of (deadline):
+    return wheel.bucket (deadline)
+
+def schedule (keys, deadline):
+    """
+    Puts the rooms in the slot of the deadline, with one batch of memcache
+    calls for all of them. A deadline in the tick under way, or before it,
+    goes to the next tick: the task of the current tick may be done already
+    """
+    if keys:
+        wheel.add_multi (keys, max (deadline, (tick_of (time.time ()) + 1) * TICK))
+
+def due (tick):
+    """
+    The keys of the rooms listed in the slot of the tick
+    """
+    keys = []
+    for key, deadline in wheel.slots (tick):
+        if key not in keys:
+            keys.append (key)
+    return keys
+
+def tick (advance, now=None):
+    """
+    Hands the rooms of every slot which came due since the last tick to
+    advance (keys, now). Returns the number of rooms handed over.
+    """
+    now = now or time.time ()
+    current = tick_of (now)
+    last = memcache.get (LAST_TICK_KEY)
+    if last is None or current - last > HORIZON / TICK:
+        last = current - 1
+    rooms = 0
+    for t in xrange (last + 1, current + 1):
+        keys = due (t)
+        if keys:
+            advance (keys, now)
+            rooms += len (keys)
+        memcache.set (LAST_TICK_KEY, t)
+    if rooms:
+        logging.info ('Tick %d advanced %d rooms' % (current, rooms))
+    return rooms
+
+def enqueue_next (now=None):
+    """
+    Enqueues the tick task of the next tick, unless it is there already
+    """
+    next_tick = tick_of (now or time.time ()) + 1
+    try:
+        taskqueue.add (url=TICK_URL, queue_name=TICK_QUEUE,
+                       name='rounds-tick-%d' % next_tick,
+                       eta=datetime.datetime.utcfromtimestamp (next_tick * TICK))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Sweeper of abandoned rooms and players.
+#
+#   Rooms which have gone quiet for longer than their max_wait_time are
+#   ended, and players who have not been seen for PLAYER_IDLE seconds and
+#   have no live channel left die. Quiet is judged by last_active, which only
+#   activity of players and the rounds of a game under way move on; `updated`
+#   is refreshed by every encoding of a cached entity and says nothing about
+#   activity. A sweep walks the candidates with a keys-only query, BATCH keys
+#   at a time, every batch in a task of its own which carries the query
+#   cursor on to the next one. The entities of a batch are loaded, deleted
+#   and purged from memcache in bulk.
+#
+#   Rooms and players stored before last_active existed do not have it and
+#   no query on it finds them. The backfill sweeps, started once, walk all
+#   of them and give those the time they were created.
+#
+#   Sweeping must not compete with live traffic: batches are spaced so that
+#   a sweep handles at most RATE entities a second, and the sweep queue
+#   runs one task at a time.
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import taskqueue
+
+from tournament2 import DeathMatch, Player, get2, store_entities
+import presence
+
+SWEEP_URL = '/tasks/sweep'
+SWEEP_QUEUE = 'sweep'
+
+BATCH = 100             # entities per task
+RATE = 20               # entities a second, at most
+SWEEP_EVERY = 10 * 60   # seconds between the starts of two sweeps
+
+PLAYER_IDLE = 2 * 60 * 60   # seconds without a write before a player is swept
+
+def _cutoff (seconds, now):
+    return datetime.datetime.utcfromtimestamp (now - seconds)
+
+def quiet_rooms (cursor, now):
+    query = DeathMatch.all (keys_only=True)
+    query.filter ('last_active <', _cutoff (DeathMatch.max_wait_time.default, now))
+    if cursor:
+        query.with_cursor (cursor)
+    return query.fetch (BATCH), query.cursor ()
+
+def sweep_rooms (keys, now):
+    """
+    Ends the rooms which are still quiet once loaded: their cached copy may
+    be more recent than the datastore the query ran on
+    """
+    quiet = []
+    for room in get2 (keys):
+        if room is None or room.active_since is None:
+            continue
+        if room.active_since < _cutoff (room.max_wait_time, now):
+            quiet.append (room)
+    if quiet:
+        DeathMatch.end_rooms (quiet)
+    return len (quiet)
+
+def idle_players (cursor, now):
+    query = Player.all (keys_only=True)
+    query.filter ('last_active <', _cutoff (PLAYER_IDLE, now))
+    if cursor:
+        query.with_cursor (cursor)
+    return query.fetch (BATCH), query.cursor ()
+
+def sweep_players (keys, now):
+    """
+    Lets the players with no live channel die
+    """
+    cutoff = _cutoff (PLAYER_IDLE, now)
+    gone = [x for x in get2 (keys)
+            if x is not None and (x.active_since is None or x.active_since < cutoff)
+            and not presence.live (x.channels)]
+    if gone:
+        Player.die_many (gone)
+    return len (gone)
+
+def all_keys (model_class):
+    def find (cursor, now):
+        query = model_class.all (keys_only=True)
+        if cursor:
+            query.with_cursor (cursor)
+        return query.fetch (BATCH), query.cursor ()
+    return find
+
+def backfill (keys, now):
+    """
+    Gives the entities which have no last_active the time they were created
+    """
+    missing = [x for x in get2 (keys) if x is not None and x.last_active is None]
+    for entity in missing:
+        entity.last_active = entity.created
+    if missing:
+        store_entities (missing)
+    return len (missing)
+
+SWEEPS = {
+    'rooms' : (quiet_rooms, sweep_rooms),
+    'players' : (idle_players, sweep_players),
+    'rooms_backfill' : (all_keys (DeathMatch), backfill),
+    'players_backfill' : (all_keys (Player), backfill),
+}
+
+#   Started once: the task names are not periodic, and only fresh ones are
+#   run
+BACKFILLS = ('rooms_backfill', 'players_backfill')
+
+def _enqueue (name, cursor=None, countdown=0, task_name=None):
+    params = {'sweep' : name}
+    if cursor:
+        params['cursor'] = cursor
+    try:
+        taskqueue.add (url=SWEEP_URL, queue_name=SWEEP_QUEUE, params=params,
+                       countdown=countdown, name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def start (now=None):
+    """
+    Starts every sweep, at most once per SWEEP_EVERY seconds, and the
+    backfills unless they have run already
+    """
+    period = int ((now or time.time ()) / SWEEP_EVERY)
+    for name in SWEEPS:
+        if name in BACKFILLS:
+            _enqueue (name, task_name='sweep-%s' % name)
+        else:
+            _enqueue (name, task_name='sweep-%s-%d' % (name, period))
+
+def run (name, cursor=None, now=None):
+    """
+    Sweeps one batch and enqueues the next one, spaced to keep within RATE.
+    Returns the number of entities swept.
+    """
+    now = now or time.time ()
+    find, sweep = SWEEPS[name]
+    keys, cursor = find (cursor, now)
+    swept = 0
+    if keys:
+        swept = sweep (keys, now)
+    if len (keys) == BATCH:
+        _enqueue (name, cursor, countdown=BATCH / RATE)
+    logging.info ('Sweep of %s: %d of %d swept' % (name, swept, len (keys)))
+    return swept
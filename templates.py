@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Compiled templates, cached per process.
+#
+#   A template is loaded and compiled the first time it is asked for and
+#   then kept for the life of the process. On the development server the
+#   file's modification time is checked on every use, and the template
+#   compiled again when it has changed, so that edits show up right away.
+
+import os
+
+import lazy
+
+#   The template engine brings django in, it is loaded with the first page
+template = lazy.module ('google.appengine.ext.webapp.template')
+django_template = lazy.module ('django.template')
+
+ROOT = os.path.dirname (os.path.abspath (__file__))
+
+RELOAD = os.environ.get ('SERVER_SOFTWARE', '').startswith ('Development')
+
+_cache = {}     # path -> (mtime, compiled template)
+
+def get (path):
+    """
+    The compiled template. Paths are relative to the application root
+    """
+    path = os.path.join (ROOT, path)
+    cached = _cache.get (path)
+    if cached is not None and not RELOAD:
+        return cached[1]
+    mtime = os.path.getmtime (path)
+    if cached is None or cached[0] != mtime:
+        #   Debug output only where templates are being edited
+        cached = _cache[path] = (mtime, template.load (path, debug=RELOAD))
+    return cached[1]
+
+def render (path, values):
+    compiled = get (path)
+    return compiled.render (django_template.Context (values))
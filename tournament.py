@@ -32,10 +32,10 @@ from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext.db import TransactionFailedError
 
-from google.appengine.datastore import entity_pb
-
 from django.utils import simplejson
 
+from codec import serialize_entities, deserialize_entities
+
 #    The maximum number of participants in the event
 #    Keep it -1 for unlimited access
 
@@ -54,21 +54,6 @@ def gen_channel(userid):
     seed = userid + str(int(time.time()))
     return md5.md5(seed).hexdigest()
 
-def serialize_entities(models):
-    if models is None:
-        return None
-    elif isinstance(models, db.Model):
-        return db.model_to_protobuf(models).Encode()
-    else:
-        return [db.model_to_protobuf(x).Encode() for x in models]
-
-def deserialize_entities(data):
-    if data is None:
-        return None
-    elif isinstance(data, str):
-        return db.model_from_protobuf(entity_pb.EntityProto(data))
-    else:
-        return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
 
 
 class EfficientModel(db.Model):
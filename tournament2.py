@@ -22,22 +22,38 @@ __author__ = 'Pranav Prakash < x@pranavprakash.in>'
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import md5
+import datetime
 import logging
 import time, random
 
-from google.appengine.api import channel
 from google.appengine.api import memcache
 from google.appengine.api import datastore
-from google.appengine.api import taskqueue
 
 from google.appengine.ext import db
-from google.appengine.ext.db import TransactionFailedError
-
-from google.appengine.datastore import entity_pb
 
+#   Every update sent is encoded with it, not worth importing lazily
 from django.utils import simplejson
 
+import lazy
+md5 = lazy.module ('md5')
+
+from codec import serialize_entities, deserialize_entities
+
+import fanout
+import identitymap
+import ignores
+import metrics
+import occupancy
+import powerups
+import presence
+import recovery
+import rounds
+from matchmaking import Matchmaker
+from deltastream import DeltaStream
+import writebehind
+from lrucache import LRUCache
+from chat import ChatLog, RecentChat
+
 #    The maximum number of participants in the event
 #    Keep it -1 for unlimited access
 
@@ -46,12 +62,16 @@ MAX_PLAYERS = 5
 
 ROUND_TIME = 30 # how long a round lasts in seconds
 MAX_WAIT_TIME = 180 # how long a player shall wait for others to join
+MIN_PLAYERS = 2 # players needed to start a game
 
-LATEST_GAMEROOM = 'latest_gameroom'
 POWERUP_ACTIVE_TIME = 3
 POWERUP_REFILLS_IN = 5
 MAX_CONCURRENT_CHANNEL = 30
 
+#   Channels a player keeps, one per open page. Opening more pages drops
+#   the oldest channels
+MAX_PLAYER_CHANNELS = 3
+
 #   The maximum difference in revisions acceptable  at any instant
 #   between memcached values and the datastore values. The higher it
 #   is, the greater catastrophe when memcache goes down, but lesser
@@ -59,25 +79,12 @@ MAX_CONCURRENT_CHANNEL = 30
 #   and memcache are, and higher datastore operations. 4~6
 FAULT_TOLERANCE = 4
 
-def gen_channel(userid):
-    seed = userid + str(int(time.time()))
-    return md5.md5(seed).hexdigest()
-
-def serialize_entities(models):
-    if models is None:
-        return None
-    elif isinstance(models, db.Model):
-        return db.model_to_protobuf(models).Encode()
-    else:
-        return [db.model_to_protobuf(x).Encode() for x in models]
-
-def deserialize_entities(data):
-    if data is None:
-        return None
-    elif isinstance(data, str):
-        return db.model_from_protobuf(entity_pb.EntityProto(data))
-    else:
-        return [db.model_from_protobuf(entity_pb.EntityProto(x)) for x in data]
+#   Powerup definitions compiled at most, and the stats of a player before
+#   any powerup
+MAX_POWERUPS = 1000
+HEALTH = 100
+ATTACK = 10
+DEFENSE = 10
 
 class BaseTextMessage (object):
     """
@@ -109,13 +116,37 @@ class Chat (BaseTextMessage):
 #   Caching Model
 #   http://appengine-cookbook.appspot.com/recipe/models-caching/
 
-_db_get_global_cache = {}
+#   Entities are cached in process memory, bounded by both number and size,
+#   and checked against a revision number kept in memcache which every put
+#   and delete bumps, so that writes from other instances invalidate them.
+GLOBAL_CACHE_ITEMS = 1000
+GLOBAL_CACHE_BYTES = 8 * 1024 * 1024
+GLOBAL_CACHE_TTL = 60
+
+_db_get_global_cache = LRUCache (GLOBAL_CACHE_ITEMS, GLOBAL_CACHE_BYTES,
+                                 GLOBAL_CACHE_TTL)
+
+def _revision_key (key):
+    return 'rev:' + str (key)
 
 def get (keys, **kwargs):
     keys, multiple = datastore.NormalizeAndTypeCheckKeys (keys)
-    getted = db.get([key for key in keys if key not in _db_get_global_cache], **kwargs)
-    _db_get_global_cache.update (dict ([(x.key(), x) for x in getted]))
-    ret = [_db_get_global_cache[k] for k in keys]
+    revisions = memcache.get_multi (map (_revision_key, keys))
+    ret = []
+    keys_to_fetch = []
+    for key in keys:
+        entity = _db_get_global_cache.get (key, revisions.get (_revision_key (key), 0))
+        if entity is None:
+            keys_to_fetch.append (key)
+        ret.append (entity)
+    if keys_to_fetch:
+        getted = dict ((x.key (), x) for x in db.get (keys_to_fetch, **kwargs)
+                       if x is not None)
+        for key, entity in getted.items ():
+            _db_get_global_cache.set (key, entity,
+                                      revisions.get (_revision_key (key), 0),
+                                      len (serialize_entities (entity)))
+        ret = [x or getted.get (k) for k, x in zip (keys, ret)]
     if multiple:
         return ret
     if len (ret) > 0:
@@ -123,8 +154,16 @@ def get (keys, **kwargs):
 
 def rm (keys):
     keys, _ = datastore.NormalizeAndTypeCheckKeys (keys)
+    memcache.offset_multi (dict ((_revision_key (k), 1) for k in keys),
+                           initial_value=0)
     return [_db_get_global_cache.pop (k) for k in keys if k in _db_get_global_cache]
 
+def global_cache_stats ():
+    """
+    Hit, miss and eviction counters of this instance's entity cache
+    """
+    return _db_get_global_cache.stats ()
+
 class GlobalCachingModel(db.Model):
 
     def put(self):
@@ -134,7 +173,7 @@ class GlobalCachingModel(db.Model):
     
     def delete (self):
         rm(self.key())
-        return super(CachingModel, self).delete()
+        return super(GlobalCachingModel, self).delete()
     
     @classmethod
     def get_by_key_name(cls, key_names, parent=None, **kwargs):
@@ -154,21 +193,151 @@ class GlobalCachingModel(db.Model):
 #   internal versioning of the information and more economical use
 #   of datastore calls for read and write
 
+#   Cached in place of the entities which are not in the datastore, so that
+#   looking them up again, like Player.from_id does for every new user, does
+#   not cost a datastore get each time. A put of the entity overwrites it.
+MISSING = '__missing__'
+MISSING_TTL = 60
+
+@metrics.timed ('get2')
 def get2 (keys, **kwargs):
+    """
+    Bulk loads the entities, in the order of the keys, with one memcache
+    get_multi and one datastore get for the keys memcache does not know of.
+    Entities which do not exist are returned as None. Within a request,
+    entities already loaded are returned as the same instance.
+    """
     keys, multiple = datastore.NormalizeAndTypeCheckKeys (keys)
-    getted_cache = memcache.get_multi (map (str, keys))
-    ret = map (deserialize_entities, getted_cache.values ())
-    keys_to_fetch = [key for key in keys if getted_cache.get(key, None) is not None]
-    getted_db = db.get(keys_to_fetch)
-    memcache_to_set = dict ((k,v) for k,v in zip (map (str,keys_to_fetch), 
-                                            map (serialize_entities, getted_db)))
-    ret.extend(getted_db)
-    memcache.set_multi (memcache_to_set)
+    str_keys = map (str, keys)
+    found = {}
+    for str_key in str_keys:
+        known, entity = identitymap.lookup (str_key)
+        if known:
+            found[str_key] = entity
+    metrics.incr ('identitymap.hit', len (found))
+    keys_to_load = [key for key, str_key in zip (keys, str_keys) if str_key not in found]
+    if keys_to_load:
+        loaded = _load (keys_to_load, **kwargs)
+        for str_key, entity in loaded.items ():
+            identitymap.remember (str_key, entity)
+        found.update (loaded)
+    ret = [found[str_key] for str_key in str_keys]
     if multiple:
         return ret
     if len (ret) > 0:
         return ret[0]
 
+def _load (keys, **kwargs):
+    str_keys = map (str, keys)
+    #   The cache generation comes along, to notice when memcache was lost
+    getted_cache = memcache.get_multi (str_keys + [recovery.GENERATION_KEY])
+    generation = getted_cache.pop (recovery.GENERATION_KEY, None)
+    recovery.check (generation, len ([x for x in getted_cache.values () if x != MISSING]))
+    keys_to_fetch = [key for key, str_key in zip (keys, str_keys)
+                     if str_key not in getted_cache]
+    metrics.incr ('memcache.hit', len (getted_cache))
+    metrics.incr ('memcache.miss', len (keys_to_fetch))
+    getted_db = {}
+    if keys_to_fetch:
+        getted_db = dict (zip (map (str, keys_to_fetch), db.get (keys_to_fetch, **kwargs)))
+        metrics.incr ('datastore.read', len (keys_to_fetch))
+        serialized = dict ((k, serialize_entities (v))
+                           for k, v in getted_db.items () if v is not None)
+        metrics.incr ('codec.bytes_encoded', sum (map (len, serialized.values ())))
+        #   add, not set: a copy written meanwhile is newer than the datastore's
+        memcache.add_multi (serialized)
+        for str_key, data in serialized.items ():
+            getted_db[str_key]._base = data
+        missing = [k for k, v in getted_db.items () if v is None]
+        if missing:
+            memcache.set_multi (dict.fromkeys (missing, MISSING), time=MISSING_TTL)
+    for str_key, data in getted_cache.items ():
+        if data == MISSING:
+            getted_db[str_key] = None
+        else:
+            metrics.incr ('codec.bytes_decoded', len (data))
+            entity = getted_db[str_key] = deserialize_entities (data)
+            entity._base = data
+    return getted_db
+
+write_behind = writebehind.WriteBehind (serialize_entities, deserialize_entities,
+                                        missing=MISSING)
+
+def delete_entities (entities):
+    """
+    Deletes the entities from memcache and the datastore, with one call
+    to each
+    """
+    keys = [x.keyname for x in entities]
+    identitymap.forget (keys)
+    memcache.delete_multi (keys)
+    db.delete ([x.key () for x in entities])
+    metrics.incr ('datastore.delete', len (keys))
+
+CAS_RETRIES = 5
+
+def store_entities (entities):
+    """
+    Stores new revisions of the entities in memcache and marks them dirty
+    for the write-behind.
+
+    The revisions are written with compare-and-set. When another writer has
+    stored a revision of an entity since it was loaded, the entity's
+    changes are merged into that revision and the write tried again, up to
+    CAS_RETRIES times, after which the entity overwrites it.
+    """
+    client = memcache.Client ()
+    pending = dict ((x.keyname, x) for x in entities)
+    for attempt in xrange (CAS_RETRIES):
+        cached = client.get_multi (pending.keys (), for_cas=True)
+        to_add = {}
+        to_cas = {}
+        for key, entity in pending.items ():
+            data = cached.get (key)
+            if data is not None and data != MISSING:
+                current = deserialize_entities (data)
+                if current._cache_version != entity._cache_version:
+                    entity.merge (current)
+                    #   Merged against this revision, a retry merges from it
+                    entity._base = data
+            entity._cache_version += 1
+            if data is None:
+                to_add[key] = serialize_entities (entity)
+            else:
+                to_cas[key] = serialize_entities (entity)
+        metrics.incr ('codec.bytes_encoded', sum (map (len, to_add.values () + to_cas.values ())))
+        failed = []
+        if to_add:
+            failed.extend (client.add_multi (to_add))
+        if to_cas:
+            failed.extend (client.cas_multi (to_cas))
+        metrics.incr ('memcache.write', len (to_add) + len (to_cas) - len (failed))
+        for key, data in to_add.items () + to_cas.items ():
+            if key in failed:
+                pending[key]._cache_version -= 1
+            else:
+                pending.pop (key)._base = data
+        if not pending:
+            break
+        metrics.incr ('cas.retry', len (pending))
+    else:
+        logging.warning ('Could not compare-and-set %d entities, overwriting them' % len (pending))
+        metrics.incr ('cas.exhausted', len (pending))
+        for entity in pending.values ():
+            entity._cache_version += 1
+        memcache.set_multi (dict ((k, serialize_entities (v)) for k, v in pending.items ()))
+    recovery.record_writes (entities)
+    urgent = [x.keyname for x in entities
+              if x._cache_version - x._db_version >= x._fault_tolerance]
+    metrics.incr ('fault_tolerance.flush', len (urgent))
+    write_behind.mark_multi ([x.keyname for x in entities], urgent)
+
+def _raw_value (prop, entity):
+    if isinstance (prop, db.ReferenceProperty):
+        #   the key, without fetching the referenced entity
+        return prop.get_value_for_datastore (entity)
+    return getattr (entity, prop.name)
+
 class GlobalVersionedCachingModel(db.Model):
     """
     The Model uses internal versioning of information with prime focus on very
@@ -179,6 +348,9 @@ class GlobalVersionedCachingModel(db.Model):
     than the datastore version number by a certain amount called
     "fault tolerance", then the datastor entity is sync'd with the memcache
     entity.
+
+    The datastore writes are done behind the request by the write_behind
+    flusher, which coalesces the revisions of an entity into one write.
     """
     
     _db_version = db.IntegerProperty (default=0, required=True)
@@ -201,6 +373,7 @@ class GlobalVersionedCachingModel(db.Model):
             self.update_to_db()
         memcache.delete(self.keyname)
     
+    @metrics.timed ('update_to_db')
     def update_to_db (self):
         """
         Updates the current state of the entity from memcache to the datastore
@@ -208,24 +381,74 @@ class GlobalVersionedCachingModel(db.Model):
         self._db_version = self._cache_version
         logging.info('About to write into db. Key: %s' %self.keyname)
         self.update_cache ()
+        metrics.incr ('datastore.write')
         return super (GlobalVersionedCachingModel, self).put ()
     
+    def merge (self, current):
+        """
+        Another writer stored `current` since this entity was loaded: folds
+        the changes made to `current` into this entity, which becomes the
+        next revision of it. A property changed on both sides is settled by
+        merge_property
+        """
+        base = getattr (self, '_base', None)
+        if base is not None:
+            base = deserialize_entities (base)
+        for name, prop in self.properties ().items ():
+            if name in ('_cache_version', '_db_version'):
+                continue
+            mine = _raw_value (prop, self)
+            theirs = _raw_value (prop, current)
+            original = None
+            if base is not None:
+                original = _raw_value (prop, base)
+            if mine == theirs or (base is not None and theirs == original):
+                continue
+            if base is not None and mine == original:
+                value = theirs
+            else:
+                value = self.merge_property (name, original, mine, theirs)
+            setattr (self, name, value)
+        self._cache_version = current._cache_version
+        self._db_version = max (self._db_version, current._db_version)
+        metrics.incr ('cas.merge')
+
+    def merge_property (self, name, original, mine, theirs):
+        """
+        Settles a property both writers changed. Lists keep what either side
+        added and lose what either side removed, numbers keep the highest
+        value, and so do dates, anything else keeps this entity's value. Override to merge
+        differently
+        """
+        if isinstance (mine, list) and isinstance (theirs, list):
+            original = original or []
+            return [x for x in theirs if x in mine or x not in original] + \
+                   [x for x in mine if x not in theirs and x not in original]
+        if isinstance (mine, (int, long, float)) and isinstance (theirs, (int, long, float)) \
+                and not isinstance (mine, bool):
+            return max (mine, theirs)
+        if isinstance (mine, datetime.datetime) and isinstance (theirs, datetime.datetime):
+            return max (mine, theirs)
+        return mine
+
     def update_cache (self):
         """
         Updates the memacahe for this entity
         """
         memcache.set (self.keyname, serialize_entities (self))
 
+    @metrics.timed ('put')
     def put (self):
-        self._cache_version += 1
-        memcache.set (self.keyname, serialize_entities (self))
-        logging.info('Memcache set with version: %d for keyname: %s' %( self._cache_version, self.keyname))
-        if self._cache_version - self._db_version >= self._fault_tolerance or \
-                                                self._cache_version == 1:
-            self.update_to_db ()
+        """
+        Within a request, only marks the entity dirty, it is stored with the
+        other dirty entities when the request is over
+        """
+        if not identitymap.defer_put (self):
+            store_entities ([self])
     
     def delete (self):
         self.remove_from_cache()
+        identitymap.forget ([self.keyname])
         return super (GlobalVersionedCachingModel, self).delete ()
     
     @classmethod
@@ -249,6 +472,19 @@ class BaseModel(GlobalVersionedCachingModel):
     """
     A Base Model class for all the classes to come
     """
+    #   When players last did something with the entity, set by touch. Unlike
+    #   `updated`, which every encoding of the entity moves on
+    last_active = db.DateTimeProperty ()
+
+    def touch (self):
+        """
+        Records activity on the entity. Does not PUT
+        """
+        self.last_active = datetime.datetime.utcnow ()
+
+    @property
+    def active_since (self):
+        return self.last_active or self.created
     
     @classmethod
     def from_id(cls, id, smart=True):
@@ -271,25 +507,36 @@ class BaseGameServer (BaseModel):
     max_players = db.IntegerProperty (default=MAX_PLAYERS)
     max_wait_time = db.IntegerProperty (default=MAX_WAIT_TIME)
     players = db.StringListProperty ()
-    chat = db.TextProperty ()
+    chat = db.TextProperty ()   # legacy, the chat now goes to the ChatLog
+    chat_tail = db.IntegerProperty (default=0)
     active = db.BooleanProperty (default=False)
     channels = db.StringListProperty()
     game_round = db.IntegerProperty (default=0)
     round_time = db.IntegerProperty (default=ROUND_TIME)
+    seq = db.IntegerProperty (default=0)    # last delta sent, as far as the datastore knows
+    deadline = db.FloatProperty ()  # when the room is next due on the round scheduler
     
     _delta = {}
+    _channel_owners = {}    # owners of the live channels, as last pruned
     
     @classmethod
     def join_latest_or_new (cls, player):
         """
-        When a player attempts to join a game, the server tries to connect him to the latest game room 
-        which is yet to be filled. If no empty game rooms are found, then a new game room is created
-        for that player and the player waits till someone joins it
+        When a player attempts to join a game, the server tries to connect him to one of the open
+        game rooms which are yet to be filled. If no empty game rooms are found, then a new game room
+        is created for that player and the player waits till someone joins it
+
+        The seat in the room is taken by the matchmaker before the room is touched, so concurrent
+        joins can not overfill a room. A new room is created and stored before the matchmaker
+        lets other players in. Raises matchmaking.NoSeatError when no seat was found
         """
-        latest_gameroom_id = memcache.get(LATEST_GAMEROOM)
-        if latest_gameroom_id:
-            return cls.from_id (latest_gameroom_id).add_player (player)
-        return cls ().new (player)
+        def create (room):
+            cls.new (player, room)
+        room, seat, is_new = Matchmaker (cls.kind ()).reserve (cls.max_players.default, create)
+        logging.info ('Seat %d reserved in room %s' % (seat, room))
+        if not is_new:
+            cls.from_id (room).add_player (player)
+        return room
     
     def add_player (self, player):
         """
@@ -298,30 +545,109 @@ class BaseGameServer (BaseModel):
         if self.max_players == -1 or len (self.players) < self.max_players:
             if player.keyname not in self.players:
                 self.players.append (player.keyname)
-                self.put()
+                occupancy.change (self.keyname, 1)
+            player.game_in = self.key ()
+            player.is_playing = True
+            player.touch ()
             player.put ()
-            self._delta.update ({'new_player' : 1,
-                                'name' : player.name})
+            self.touch ()
+            if not self.active and len (self.players) >= MIN_PLAYERS:
+                #   Enough players, start with the next tick
+                self.schedule (time.time ())
+            self._delta = {'new_player' : 1,
+                           'name' : player.name}
             self.update_channels_from_player (player)
             self.send_updates ()
+            #   Stored once the update is numbered, so that it keeps the seq
+            self.put ()
+            #   Catch the newcomer up on the conversation
+            self.send_snapshot (player)
         else:
-            return self.new (player)
+            #   Full after all, the matchmaker finds another seat
+            return self.join_latest_or_new (player)
     
     @classmethod
-    def new (cls, player):
+    def new (cls, player, key_name=None):
         """
         Creates a new room and adds the player to it
         """
         if not player: return
-        new_room = cls (key_name=str (time.time ()),
+        new_room = cls (key_name=key_name or str (time.time ()),
                         players = [player.keyname])
         new_room.update_channels_from_player (player)
-        new_room.put ()
-        memcache.set (LATEST_GAMEROOM, new_room.keyname) 
+        new_room.schedule (time.time () + new_room.max_wait_time)
+        new_room.touch ()
+        occupancy.change (new_room.keyname, 1)
         player.game_in = db.Key(new_room.keyname)
+        player.is_playing = True
+        player.touch ()
         player.put ()
+        new_room._delta = {'new_player' : 1,
+                           'name' : player.name}
         new_room.send_updates ()
+        #   Stored right away, not with the request: players are let in as
+        #   soon as this returns. A copy stored meanwhile is merged with it
+        store_entities ([new_room])
+        identitymap.remember (new_room.key (), new_room)
     
+    def schedule (self, deadline):
+        """
+        Sets when the room is next due on the round scheduler
+
+        NOTE:
+        This method does not PUT either
+        """
+        self.deadline = deadline
+        rounds.schedule ([self.keyname], deadline)
+
+    def advance (self, now):
+        """
+        Moves the room on at its deadline: starts the game when enough players
+        are in, or the next round. Returns the next deadline, None when the
+        room is not due.
+        """
+        if self.deadline is None or rounds.tick_of (self.deadline) > rounds.tick_of (now):
+            return None
+        if self.active:
+            self.game_round += 1
+            self._delta = {'round' : self.game_round}
+            #   A game under way is not abandoned, chat or not
+            self.touch ()
+            return now + self.round_time
+        if len (self.players) >= MIN_PLAYERS:
+            self.active = True
+            self.game_round = 1
+            self._delta = {'round' : self.game_round,
+                           'started' : 1}
+            self.touch ()
+            return now + self.round_time
+        self._delta = {'waiting' : 1}
+        return now + self.max_wait_time
+
+    @classmethod
+    def advance_rooms (cls, keys, now):
+        """
+        Advances the rooms due on a tick of the round scheduler, loaded and
+        stored in bulk, with one fan-out per room
+        """
+        rooms = [x for x in get2 ([db.Key (k) for k in keys]) if x is not None]
+        by_deadline = {}
+        advanced = []
+        for room in rooms:
+            deadline = room.advance (now)
+            if deadline is None:
+                continue
+            room.deadline = deadline
+            by_deadline.setdefault (deadline, []).append (room.keyname)
+            advanced.append (room)
+        for deadline, room_keys in by_deadline.items ():
+            rounds.schedule (room_keys, deadline)
+        for room in advanced:
+            room.send_updates ()
+        #   One store per room, with its channels as pruned by send_updates
+        identitymap.put_multi (advanced, store_entities)
+        return len (advanced)
+
     def update_channels_from_player (self, player):
         """
         Updates the Channel Listing on which the messages needs to be send. The
@@ -344,14 +670,58 @@ class BaseGameServer (BaseModel):
         Ends a gameroom. This is done by removing all the associated players and nullifying
         the existance of the room
         """
-        raise NotImplementedError
-        
+        return self.end_rooms ([self])
+
+    @classmethod
+    def end_rooms (cls, rooms):
+        """
+        Ends many rooms at once: the players of all of them are loaded and
+        stored in bulk, and the rooms deleted with one batch. The chat logs
+        are kept.
+        """
+        player_keys = []
+        for room in rooms:
+            player_keys.extend ([db.Key (x) for x in room.players])
+        players = [x for x in get2 (player_keys) if x is not None]
+        room_keys = set ([x.keyname for x in rooms])
+        leaving = []
+        for player in players:
+            if str (player.game_key) in room_keys:
+                player.game_in = None
+                player.is_playing = False
+                leaving.append (player)
+        if leaving:
+            store_entities (leaving)
+        for room in rooms:
+            room._delta = {'ended' : 1}
+            room.send_updates ()
+            if room.players:
+                occupancy.change (room.keyname, -len (room.players))
+            #   The matchmaker knows rooms by key name
+            Matchmaker (room.kind ()).close (room.key ().name ())
+        delete_entities (rooms)
+        logging.info ('Ended %d rooms, %d players left them' % (len (rooms), len (leaving)))
+        return len (rooms)
     
     def expel (self, player):
         """
         Removes a player from the game room
         """
-        raise NotImplementedError
+        if player.keyname in self.players:
+            self.players.remove (player.keyname)
+            occupancy.change (self.keyname, -1)
+            Matchmaker (self.kind ()).release (self.key ().name (), self.max_players)
+        player_channels = set (player.channels)
+        self.channels = [x for x in self.channels if x not in player_channels]
+        self.touch ()
+        if str (player.game_key) == self.keyname:
+            player.game_in = None
+            player.is_playing = False
+            player.put ()
+        self._delta = {'left' : 1,
+                       'name' : player.name}
+        self.send_updates ()
+        self.put ()
     
     def update_chat (self, player, message):
         """
@@ -362,47 +732,140 @@ class BaseGameServer (BaseModel):
         logging.info ('Chat Text: %s' %chat_text)
         self._delta.update ({ 'delta_chat' : chat_text,
                                'player' : player.keyname})
-        if self.chat:
-            self.chat += chat_text
-        else:
-            self.chat = chat_text
+        self.chat_tail = ChatLog.append (self.keyname, self.chat_tail,
+                                         player.keyname, chat_text)
+        self.touch ()
+        self.send_updates ()
         self.put ()
+
+    def use_powerup (self, player, name):
+        """
+        The player uses the powerup in the current round, and the room is
+        told of their stats with it. Raises powerups.UnavailableError when
+        it can not be used
+        """
+        player.use_powerup (name, self.game_round)
+        self._delta = {'powerup' : name,
+                       'player' : player.keyname}
+        for stat in ('health', 'attack', 'defense'):
+            self._delta[stat] = player.stat (stat, self.game_round)
+        self.touch ()
         self.send_updates ()
+        self.put ()
+        return self._delta
+
+    def chat_history (self, segment=None):
+        """
+        Returns one page of the room's chat log, the latest one by default
+        """
+        return ChatLog.read (self.keyname, self.chat_tail, segment)
     
+    def prune_channels (self):
+        """
+        Forgets the channels of the room which are not alive any more.
+        Returns True when some were dropped
+
+        NOTE:
+        This method does not PUT, the callers of send_updates store the room
+        """
+        live, self._channel_owners = presence.live_owners (self.channels)
+        if len (live) == len (self.channels):
+            return False
+        metrics.incr ('channel.pruned', len (self.channels) - len (live))
+        self.channels = live
+        return True
+
+    @metrics.timed ('send_updates')
     def send_updates (self):
         """
-        Sends an update on all the channels associated with the room
+        Sends an update on all the live channels associated with the room.
+        The update is numbered and kept in the room's delta stream, so that
+        reconnecting players can catch up on it. The room's seq is moved on
+        to it: callers store the room after sending, so that the seq stored
+        never falls behind the stream should memcache lose its counter
         """
-        message = simplejson.dumps (self._delta)
+        self.prune_channels ()
+        delta = DeltaStream (self.keyname).publish (self._delta, self.seq)
+        self.seq = delta['seq'] or self.seq
+        message = simplejson.dumps (delta)
+        channels = self.channels
+        sender = self._delta.get ('player')
+        if sender:
+            #   Not to the players who ignore the sender
+            channels = ignores.recipients (sender, channels, self._channel_owners)
         logging.info ('About to send message to %d people' %(
-                                        len (self.channels)))
-        if len (self.channels) < MAX_CONCURRENT_CHANNEL:
-            for channel_id in self.channels:
-                try:
-                    channel.send_message (channel_id, message)
-                except channel.InvalidChannelClientError, e:
-                    logging.info (e)
-                    pass
+                                        len (channels)))
+        if len (channels) < MAX_CONCURRENT_CHANNEL:
+            fanout.send_batch (channels, message)
         else:
-            #   Do an implementation of task queue here so that more than 30
+            #   Break the channels into smaller batches and let the task
+            #   queue send them, so that more than MAX_CONCURRENT_CHANNEL
             #   people can also play awesomely
-            #   The task is to break the number of people into smaller batches 
-            #   and send them update
-            logging.info ('More than MAX_CONCURRENT_CHANNEL')
-            raise NotImplementedError
-            
-    
+            batches = fanout.dispatch (channels, message)
+            logging.info ('More than MAX_CONCURRENT_CHANNEL, %d batches enqueued' % batches)
+
+    def recent_chat (self):
+        """
+        The last lines of the chat, as a page of the chat history whose
+        previous segment holds the lines before them
+        """
+        lines = RecentChat.lines (self.keyname, self.chat_tail)
+        first = self.chat_tail - len (lines)
+        previous = None
+        if first > 0:
+            previous = ChatLog.segment_of (first - 1)
+        return {'segment' : None,
+                'previous' : previous,
+                'lines' : lines}
+
+    def snapshot (self):
+        """
+        The whole state of the room a client needs to start over
+        """
+        return {'players' : self.players,
+                'active' : self.active,
+                'game_round' : self.game_round,
+                'chat' : self.recent_chat (),
+                'seq' : DeltaStream (self.keyname).current (self.seq)}
+
+    def send_snapshot (self, player):
+        """
+        Sends the state of the room, with the recent chat, to the player only.
+        The lines of the players they ignore are left out
+        """
+        snapshot = self.snapshot ()
+        lines = snapshot['chat']['lines']
+        hidden = ignores.ignoring (player.keyname, [x['player'] for x in lines])
+        if hidden:
+            snapshot['chat']['lines'] = [x for x in lines if x['player'] not in hidden]
+        fanout.send_batch (player.channels,
+                           simplejson.dumps ({'snapshot' : snapshot}))
+
     @classmethod
-    def resume (cls, channel=None):
+    def resume (cls, player, since=None):
         """
-        Sends an update on the given channel(s) about the game. This is done, when let's say
+        Sends an update on the player's channel(s) about the game. This is done, when let's say
         a user presses F5 whilst in the middle of the game. So, the game has to continue from
         where it was.
+
+        `since` is the sequence number of the last update the client has seen. It is sent only
+        the updates it missed, or a snapshot of the room when it is too far behind to catch up
         """
-        logging.info (player.game_in.key().name())
-        room = cls.from_id (player.game_in.keyname)
-        room.update_channels_from_player (player)
-        room.put ()
+        room = cls.from_id (player.game_key)
+        logging.info ('Resuming %s in room %s from %s' % (player.keyname, room.keyname, since))
+        channels = set (room.channels)
+        if channels != set (room.update_channels_from_player (player)):
+            room.put ()
+        deltas = None
+        if since is not None:
+            deltas = DeltaStream (room.keyname).since (since, room.seq)
+        if deltas is None:
+            return room.send_snapshot (player)
+        hidden = ignores.ignoring (player.keyname,
+                                   [x['player'] for x in deltas if x.get ('player')])
+        if hidden:
+            deltas = [x for x in deltas if x.get ('player') not in hidden]
+        fanout.send_batch (player.channels, simplejson.dumps ({'deltas' : deltas}))
 
 def gen_channel (id):
     """
@@ -421,6 +884,21 @@ class BasePlayer(BaseModel):
     active = db.BooleanProperty ()
     game_in = db.ReferenceProperty ()
     is_playing = db.BooleanProperty (default=False)
+    health = db.IntegerProperty (default=HEALTH)
+    attack = db.IntegerProperty (default=ATTACK)
+    defense = db.IntegerProperty (default=DEFENSE)
+    #   powerups used: name, round last used and times used
+    powerup_names = db.StringListProperty ()
+    powerup_rounds = db.ListProperty (int)
+    powerup_times = db.ListProperty (int)
+
+    @property
+    def game_key (self):
+        """
+        Key of the room the player is in. Unlike game_in, does not fetch the
+        room from the datastore, where it may not have been flushed yet
+        """
+        return BasePlayer.game_in.get_value_for_datastore (self)
    
 
     def create_channel(self):
@@ -429,15 +907,77 @@ class BasePlayer(BaseModel):
         Channel API and returns the token details
         """
         new_channel = gen_channel (self.keyname)
-        self.channels.append (new_channel)
+        channels = presence.live (self.channels)
+        keep = MAX_PLAYER_CHANNELS - 1
+        if len (channels) > keep:
+            presence.disconnected (channels[:len (channels) - keep])
+            channels = channels[len (channels) - keep:]
+        self.channels = channels + [new_channel]
+        presence.register (new_channel, self.keyname)
+        self.touch ()
         self.put ()
         return new_channel
     
+    @property
+    def powerup_usage (self):
+        return dict (zip (self.powerup_names,
+                          zip (self.powerup_rounds, self.powerup_times)))
+
+    def use_powerup (self, name, game_round):
+        """
+        Uses the powerup in the round. Raises powerups.UnavailableError when
+        it can not be used
+        """
+        usage = powerup_engine.table ().use (name, game_round, self.powerup_usage)
+        self.powerup_names = usage.keys ()
+        self.powerup_rounds = [usage[x][0] for x in self.powerup_names]
+        self.powerup_times = [usage[x][1] for x in self.powerup_names]
+        self.touch ()
+        self.put ()
+
+    def stat (self, name, game_round):
+        """
+        The player's health, attack or defense in the round, with the
+        powerups active in it
+        """
+        return powerup_engine.table ().apply (name, getattr (self, name),
+                                              game_round, self.powerup_usage)
+
+    def invite (self, other):
+        """
+        Invites the other player to a 1-on-1 chat, on their live channels.
+        Returns False, and sends nothing, when one of them ignores the other
+        """
+        if ignores.blocked (self.keyname, other.keyname):
+            metrics.incr ('ignores.invite_blocked')
+            return False
+        fanout.send_batch (presence.live (other.channels),
+                           simplejson.dumps ({'invite' : self.keyname,
+                                              'name' : self.name}))
+        return True
+
     def die(self):
         """
         The player dies and the world forgets him :-(
         """
-        raise NotImplementedError
+        return self.die_many ([self])
+
+    @classmethod
+    def die_many (cls, players):
+        """
+        Many players die at once: they leave their rooms, loaded in bulk,
+        and are deleted with one batch
+        """
+        in_rooms = [x for x in players if x.game_key is not None]
+        room_keys = list (set ([str (x.game_key) for x in in_rooms]))
+        rooms = dict (zip (room_keys, get2 ([db.Key (x) for x in room_keys])))
+        for player in in_rooms:
+            room = rooms[str (player.game_key)]
+            if room is not None:
+                room.expel (player)
+        presence.disconnected ([c for x in players for c in x.channels])
+        delete_entities (players)
+        return len (players)
     
     def leave_tournament(self):
         """
@@ -473,32 +1013,53 @@ class BasePowerup (BaseModel):
     refill = db.BooleanProperty (default=True)
     refills_in = db.IntegerProperty (default=POWERUP_REFILLS_IN)
     enabled_after = db.IntegerProperty (default=1)
+
+    def put (self):
+        """
+        Definitions are read with queries, so they go to the datastore
+        right away, and the compiled tables are rebuilt
+        """
+        ret = self.update_to_db ()
+        powerup_engine.invalidate ()
+        return ret
+
+    def delete (self):
+        ret = super (BasePowerup, self).delete ()
+        powerup_engine.invalidate ()
+        return ret
+
+powerup_engine = powerups.Engine (lambda: BasePowerup.all ().fetch (MAX_POWERUPS))
     
 
 class DeathMatch (BaseGameServer):
     game_type = 'deathmatch'
 
     @classmethod
+    @metrics.timed ('DeathMatch.from_id')
     def from_id (cls, id):
         """
         Fetches or Creates a new player based on the ID
         """
-        if isinstance (id, str):
-            id = str (db.Key.from_path ('DeathMatch', id))
-        elif isinstance (id, DeathMatch):
-            id = id.keyname
-        cached_entity = deserialize_entities (memcache.get (id))
-        if cached_entity is None:
-            db_entity = cls.get_by_key_name (id)
-            if db_entity is None:
-                return cls (key_name = unicode (id))
-            else:
-                return db_entity
-        return cached_entity        
+        if isinstance (id, DeathMatch):
+            key = id.key ()
+        elif isinstance (id, db.Key):
+            key = id
+        else:
+            #   Room ids handed around are the string form of the room's key
+            try:
+                key = db.Key (id)
+            except db.BadKeyError:
+                key = db.Key.from_path ('DeathMatch', id)
+        entity = get2 (key)
+        if entity is None:
+            entity = cls (key_name = key.name ())
+            identitymap.remember (key, entity)
+        return entity
 
 
 class Player(BasePlayer):
     @classmethod
+    @metrics.timed ('Player.from_id')
     def from_id (cls, id):
         """
         Fetches or Creates a new player based on the ID
@@ -509,23 +1070,22 @@ class Player(BasePlayer):
         """
         id = str (db.Key.from_path ('Player', id))
         logging.info ('Attempting to get user with id: %s' % (id))
-        cached_entity = deserialize_entities (memcache.get (id))
-        if cached_entity is None:
-            logging.info ('Not found in memcache ...')
-            db_entity = cls.get_by_key_name (id)
-            if db_entity is None:
-                logging.info ('Not found in DB. Creating dummy')
-                return cls (key_name = unicode (id))
-            else:
-                return db_entity
-        logging.info ('Got user from memcache')
-        return cached_entity
+        entity = cls.get_by_key_name (id)
+        if entity is None:
+            logging.info ('Not found in memcache or DB. Creating dummy')
+            entity = cls (key_name = unicode (id))
+            identitymap.remember (entity.key (), entity)
+        return entity
 
     def chat (self, message):
         """
         self.is_playing can not be used as the player can chat even before
         the actual game starts
         """
-        if self.game_in is not None:
-            DeathMatch.from_id (self.game_in).update_chat (self, message)
+        if self.game_key is not None:
+            DeathMatch.from_id (self.game_key).update_chat (self, message)
+
 
+#   Rebuilt in bulk when memcache is lost
+recovery.register (DeathMatch)
+recovery.register (Player)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Write-behind of cached entities to the datastore.
+#
+#   A put on a cached model only writes memcache and marks the entity dirty.
+#   Dirty keys are collected per time bucket of FLUSH_INTERVAL seconds, every
+#   key at most once per bucket, and a worker task flushes them: it reads the
+#   latest cached copy of each entity, so many versions of one entity end up
+#   as a single write, and puts them in batched multi-entity puts.
+#
+#   A bucket is flushed when it closes (time trigger) or as soon as another
+#   FLUSH_COUNT keys have been marked in it (count trigger). The keys of a
+#   flush are unmarked before their cached copies are read, so that a key
+#   put again afterwards takes a new slot of the bucket and is flushed with
+#   it. An entity which is too many revisions ahead of its datastore copy
+#   can ask for an urgent flush of itself, at most once per bucket. Either
+#   way the request which did the put never waits for the datastore.
+#
+#   The dirty keys do not expire, however far behind the flushes fall; each
+#   flush deletes the slots it has written.
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+
+from google.appengine.ext import db
+
+import lazy
+import metrics
+
+taskqueue = lazy.module ('google.appengine.api.taskqueue')
+
+FLUSH_URL = '/tasks/flush'
+FLUSH_QUEUE = 'writebehind'
+
+FLUSH_INTERVAL = 10     # seconds a bucket collects dirty keys
+FLUSH_COUNT = 50        # keys after which a bucket is flushed early
+PUT_BATCH = 100         # entities per datastore put
+
+#   Flushes lagging more than this many seconds behind the first put are
+#   logged as warnings
+LAG_WARNING = 60
+
+LAG_KEY = 'writebehind:lag'
+
+class DirtySet (object):
+    """
+    A set of keys kept in memcache and split in time buckets. Every key is
+    recorded at most once per bucket, in a numbered slot, so that a bucket
+    can be read back in one get_multi or in ranges of slots. Buckets are
+    kept for `ttl` seconds, ten intervals by default, for good with 0.
+    """
+    def __init__ (self, namespace, interval, ttl=None):
+        self.namespace = namespace
+        self.interval = interval
+        if ttl is None:
+            ttl = interval * 10
+        self.ttl = ttl
+
+    def bucket (self, now=None):
+        return int ((now or time.time ()) / self.interval)
+
+    def _count_key (self, bucket):
+        return '%s:count:%d' % (self.namespace, bucket)
+
+    def _slot_key (self, bucket, slot):
+        return '%s:slot:%d:%d' % (self.namespace, bucket, slot)
+
+    def _mark_key (self, bucket, key):
+        return '%s:mark:%d:%s' % (self.namespace, bucket, key)
+
+    def add (self, key, now=None):
+        """
+        Records the key in the current bucket. Returns (bucket, slot), the
+        slot being None when the key was already in the bucket.
+        """
+        bucket, slots = self.add_multi ([key], now)
+        return bucket, slots and slots[0] or None
+
+    def add_multi (self, keys, now=None):
+        """
+        Records the keys in the current bucket with three memcache calls at
+        most. Returns the bucket and the slots of the keys which were not in
+        the bucket yet.
+        """
+        now = now or time.time ()
+        bucket = self.bucket (now)
+        ttl = self.ttl
+        mark_keys = dict ((self._mark_key (bucket, k), k) for k in keys)
+        known = memcache.add_multi (dict.fromkeys (mark_keys, 1), time=ttl)
+        new_keys = [k for m, k in mark_keys.items () if m not in known]
+        if not new_keys:
+            return bucket, []
+        last = memcache.incr (self._count_key (bucket), delta=len (new_keys),
+                              initial_value=0)
+        if last is None:
+            return bucket, []
+        slots = range (last - len (new_keys) + 1, last + 1)
+        memcache.set_multi (dict ((self._slot_key (bucket, slot), (key, now))
+                                  for slot, key in zip (slots, new_keys)), time=ttl)
+        return bucket, slots
+
+    def unmark (self, bucket, keys):
+        """
+        Lets the keys be recorded again in the bucket, in new slots
+        """
+        if keys:
+            memcache.delete_multi ([self._mark_key (bucket, k) for k in keys])
+
+    def drop (self, bucket, first, last, count=False):
+        """
+        Deletes the slots of the bucket from `first` to `last`, and its count
+        """
+        keys = [self._slot_key (bucket, x) for x in xrange (first, last + 1)]
+        if count:
+            keys.append (self._count_key (bucket))
+        if keys:
+            memcache.delete_multi (keys)
+
+    def count (self, bucket):
+        return int (memcache.get (self._count_key (bucket)) or 0)
+
+    def slots (self, bucket, first=1, last=None):
+        """
+        Returns the (key, marked at) pairs recorded in the given slots of
+        the bucket, all of them from `first` on by default
+        """
+        if last is None:
+            last = self.count (bucket)
+        slot_keys = [self._slot_key (bucket, x) for x in xrange (first, last + 1)]
+        if not slot_keys:
+            return []
+        found = memcache.get_multi (slot_keys)
+        return [found[k] for k in slot_keys if k in found]
+
+class WriteBehind (object):
+    """
+    Flushes dirty cached entities to the datastore from a worker task.
+    `encode` and `decode` turn an entity into its cached form and back.
+    `missing` is what is cached for an entity which does not exist, there
+    is nothing to flush for it.
+    """
+    def __init__ (self, encode, decode, namespace='writebehind', missing=None):
+        self.encode = encode
+        self.decode = decode
+        self.missing = missing
+        #   Kept until flushed, see flush_bucket
+        self.dirty = DirtySet (namespace, FLUSH_INTERVAL, ttl=0)
+
+    def mark (self, key, urgent=False):
+        """
+        Marks the cached entity under `key` dirty. With urgent, the entity
+        is flushed right away instead of with the rest of its bucket.
+        """
+        if urgent:
+            return self.mark_multi ([key], [key])
+        return self.mark_multi ([key])
+
+    def mark_multi (self, keys, urgent=()):
+        """
+        Marks the cached entities dirty, the `urgent` ones among them to be
+        flushed right away
+        """
+        bucket, slots = self.dirty.add_multi (keys)
+        for key in urgent:
+            #   One urgent flush per key and bucket, however many puts ask
+            self._enqueue ({'keys' : key},
+                           name='flush-urgent-%d-%s' % (bucket, hashlib.md5 (key).hexdigest ()))
+        if not slots:
+            return
+        if slots[0] == 1:
+            #   first keys of the bucket, flush them once the bucket closes
+            countdown = (bucket + 1) * FLUSH_INTERVAL - time.time () + 1
+            self._enqueue ({'bucket' : bucket},
+                           name='flush-%d' % bucket,
+                           countdown=max (int (countdown), 0))
+        for slot in slots:
+            if slot % FLUSH_COUNT == 0:
+                self._enqueue ({'bucket' : bucket,
+                                'first' : slot - FLUSH_COUNT + 1,
+                                'last' : slot},
+                               name='flush-%d-%d' % (bucket, slot))
+
+    def _enqueue (self, params, name=None, countdown=0):
+        try:
+            taskqueue.add (url=FLUSH_URL, queue_name=FLUSH_QUEUE,
+                           params=params, name=name, countdown=countdown)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    def flush_bucket (self, bucket, first=None, last=None):
+        """
+        Flushes the keys of the bucket. Without a range, the bucket has
+        closed and whatever the count trigger has not flushed is.
+        """
+        closing = first is None
+        if closing:
+            last = self.dirty.count (bucket)
+            first = (last / FLUSH_COUNT) * FLUSH_COUNT + 1
+        entries = self.dirty.slots (bucket, first, last)
+        keys = [key for key, marked_at in entries]
+        #   Unmarked before the cached copies are read: a put from now on
+        #   takes a new slot, which a later flush of the bucket covers
+        self.dirty.unmark (bucket, keys)
+        flushed = 0
+        if entries:
+            flushed = self.flush (keys)
+            self.record_lag (min ([marked_at for key, marked_at in entries]))
+        self.dirty.drop (bucket, first, last, count=closing)
+        return flushed
+
+    def flush (self, keys):
+        """
+        Writes the latest cached copy of every key to the datastore in
+        batched puts. Returns the number of entities written.
+        """
+        client = memcache.Client ()
+        cached = client.get_multi (keys, for_cas=True)
+        entities = []
+        missing = []
+        for key in keys:
+            if key in cached and self.missing is not None and cached[key] == self.missing:
+                missing.append (key)
+            elif key in cached:
+                entity = self.decode (cached[key])
+                entity._db_version = entity._cache_version
+                entities.append (entity)
+            else:
+                logging.warning ('Dirty entity %s is gone from memcache' % key)
+        if missing:
+            #   Deleted since they were marked, a put marks them again
+            logging.info ('Dirty entities %s do not exist any more' % ', '.join (missing))
+            self.dirty.unmark (self.dirty.bucket (), missing)
+        for i in xrange (0, len (entities), PUT_BATCH):
+            db.put (entities[i:i + PUT_BATCH])
+        metrics.incr ('datastore.write', len (entities))
+        metrics.incr ('writebehind.flushed', len (entities))
+        #   Only write the new datastore version back to memcache when
+        #   nobody has put a newer revision in the mean time
+        client.cas_multi (dict ((str (x.key ()), self.encode (x)) for x in entities))
+        logging.info ('Write-behind flushed %d entities' % len (entities))
+        return len (entities)
+
+    def record_lag (self, marked_at):
+        lag = time.time () - marked_at
+        memcache.set (LAG_KEY, lag)
+        if lag > LAG_WARNING:
+            logging.warning ('Write-behind flush is lagging %.1f seconds' % lag)
+        return lag
+
+def current_lag ():
+    """
+    Seconds between the oldest write and its flush, as of the last flush
+    """
+    return memcache.get (LAG_KEY)